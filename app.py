@@ -1,10 +1,197 @@
 import numpy as np
-import matplotlib.pyplot as plt
 from PIL import Image
 import streamlit as st
 st.set_page_config(layout='wide', page_title="ImageSVD", page_icon="icons/angle-down-solid.svg", initial_sidebar_state='collapsed')
+import copy
+import hashlib
+import os
 import time
-from processor import Decompose
+from concurrent.futures import ThreadPoolExecutor
+import svdz
+from cache import FactorCache, derived_key
+from codec import FORMATS, encode_image
+from instrument import Profiler, stage_logger
+from plots import YCBCR_CHANNELS, SpectrumFigures, channel_names
+from preview import downscale, map_rank
+from processor import Decompose, Spectrum, progressive, progressive_ranks
+
+
+# Budget for decompositions kept in memory across reruns and sessions (in MB)
+FACTOR_CACHE_MB = int(os.environ.get("IMAGESVD_FACTOR_CACHE_MB", 512))
+# Seconds cached factors and encoded downloads are kept after their last use, as promised on the privacy page
+CACHE_TTL = int(os.environ.get("IMAGESVD_CACHE_TTL", 600))
+# Set to emit one JSON line per processing stage on stderr, for monitoring
+STAGE_LOG = bool(os.environ.get("IMAGESVD_STAGE_LOG"))
+# Peak memory one decomposition may use (in MB), larger uploads fall back to a truncated or tiled SVD. 0 disables it.
+MEMORY_LIMIT_MB = int(os.environ.get("IMAGESVD_MEMORY_LIMIT_MB", 2048))
+# Uploads with a longer side than this are first decomposed at PREVIEW_SIDE while the full image is done in the background
+PREVIEW_THRESHOLD = int(os.environ.get("IMAGESVD_PREVIEW_THRESHOLD", 1024))
+PREVIEW_SIDE = 512
+
+
+@st.cache_resource
+def get_factor_cache():
+    return FactorCache(max_bytes=FACTOR_CACHE_MB * 1024 * 1024, ttl=CACHE_TTL)
+
+
+@st.cache_resource
+def get_background_executor():
+    # One full resolution decomposition at a time for all sessions, each one already uses every core
+    return ThreadPoolExecutor(max_workers=1)
+
+
+def get_upload(image):
+    # Returns (key, PIL image, pixels). The upload is hashed and decoded once, so a rerun such as a slider move
+    # neither decodes the file again nor hashes millions of pixels to find its factors.
+    upload = st.session_state.get("upload")
+    if upload is None or upload[0] != image.file_id:
+        pil_img = Image.open(image)
+        # Like batch.decode_image: grayscale stays one channel, everything else (CMYK, palette, alpha) becomes RGB
+        pil_img = pil_img.convert("L" if pil_img.mode in ("L", "I", "I;16") else "RGB")
+        upload = st.session_state["upload"] = (image.file_id, hashlib.blake2b(image.getvalue(), digest_size=16).hexdigest(),
+                                               pil_img, np.asarray(pil_img))
+    return upload[1:]
+
+
+def drop_full_resolution_job():
+    # A superseded job that has not started yet would delay the jobs of every other session, so it is cancelled.
+    # One that is already running cannot be interrupted and finishes into the cache.
+    job = st.session_state.pop("full_resolution_job", None)
+    if job is not None:
+        job[1].cancel()
+
+
+def get_factors(decomposer, img):
+    # Returns (factors, preview decomposer). Large uploads that are not cached yet get the factors of a downscaled
+    # copy and its decomposer, while the full image is decomposed in the background and picked up by a later rerun.
+    # The job lives in the session rather than only in the cache, so factors too large to cache still arrive.
+    # It is dropped as soon as another image or setting is shown, so its factors do not outlive their use.
+    key = decomposer.cache_key(img)
+    job = st.session_state.get("full_resolution_job")
+    if job is not None and job[0] != key:
+        drop_full_resolution_job()
+        job = None
+    factors = decomposer.cached(img)
+    if factors is not None:
+        return factors, None
+    if max(img.shape[:2]) <= PREVIEW_THRESHOLD:
+        return decomposer.decompose(img), None
+
+    if job is None:
+        # A copy without the profiler, which belongs to this run and must not be written to from another thread
+        background = copy.copy(decomposer)
+        background.profiler = None
+        job = st.session_state["full_resolution_job"] = (key, get_background_executor().submit(background.decompose, img))
+    if job[1].done():
+        return job[1].result(), None
+
+    small = downscale(img, PREVIEW_SIDE)
+    preview = Decompose(img=small, cache=decomposer.cache, workers=decomposer.workers, profiler=decomposer.profiler,
+                        color_mode=decomposer.color_mode, dtype=decomposer.dtype)
+    return preview.decompose(small), preview
+
+
+def carry_rank(factors):
+    # When the decomposition behind the slider changes, e.g. the full resolution replacing the preview,
+    # move the slider to the rank that keeps the same share of the energy
+    shown = st.session_state.get("rank_factors")
+    if shown is not factors:
+        if shown is not None and "rank" in st.session_state:
+            slider_factors = getattr(factors, "luma", factors)
+            st.session_state["rank"] = min(map_rank(st.session_state["rank"], shown, factors), slider_factors.max_rank - 1)
+        st.session_state["rank_factors"] = factors
+
+
+def rank_slider(factors):
+    return st.slider(
+        "**SLIDE TO ADJUST THE RANK**",
+        min_value=0, max_value=factors.max_rank - 1, key="rank",
+        help="Higher the rank, closer the compressed image is to the original image.")
+
+
+def choose_rank(decomposer, factors):
+    # In YCbCr mode chroma follows the luma rank at a lower ratio, so quality targets are measured on luma
+    factors = getattr(factors, "luma", factors)
+    mode = st.radio("**COMPRESSION TARGET**", ["Rank", "Target quality"], horizontal=True,
+                    help="Pick the rank yourself, or let ImageSVD find the smallest rank that reaches a quality target.")
+    if mode == "Rank":
+        return rank_slider(factors)
+    spectrum = get_spectrum(factors, "rank")
+    metric = st.radio("**QUALITY MEASURE**", ["PSNR", "Energy kept"], horizontal=True)
+    if metric == "PSNR":
+        target = st.slider("**TARGET PSNR (dB)**", min_value=20.0, max_value=50.0, value=35.0, step=0.5,
+                           help="Peak signal-to-noise ratio of the compressed image. Around 30-35 dB is hard to tell apart from the original.")
+        rank = decomposer.select_rank(factors, target, metric="psnr", spectrum=spectrum)
+    else:
+        target = st.slider("**TARGET ENERGY (%)**", min_value=90.0, max_value=99.9, value=99.0, step=0.1,
+                           help="Share of the squared singular values kept by the compressed image.")
+        rank = decomposer.select_rank(factors, target / 100, metric="energy", spectrum=spectrum)
+    rank = min(rank, factors.max_rank - 1)
+    curves = spectrum.curves
+    st.caption(f"Rank {rank}: {curves['joint_psnr'][rank]:.1f} dB PSNR, {curves['joint_energy'][rank] * 100:.2f} % of the energy kept")
+    return rank
+
+
+def get_reconstructor(factors, dtype, **options):
+    # Keep one set of reconstruction buffers per session and only rebuild them for a new decomposition.
+    # Also tells whether the reconstructor is new, i.e. nothing has been shown for these factors yet.
+    reconstructor = st.session_state.get("reconstructor")
+    created = reconstructor is None or reconstructor.factors is not factors or reconstructor.dtype != dtype
+    if created:
+        reconstructor = st.session_state["reconstructor"] = factors.reconstructor(dtype=dtype, **options)
+    # Options such as the chroma ratio only affect the next call and can change without new buffers
+    for name, value in options.items():
+        setattr(reconstructor, name, value)
+    return reconstructor, created
+
+
+def show_compressed(placeholder, reconstructor, rank, preview, label="Compressed Image"):
+    # A new image is shown coarse right away and refined at ranks 1, 2, 4, ..., which together cost about one
+    # full reconstruction. Slider moves on the same image are a single incremental step instead.
+    ranks = progressive_ranks(rank, first=4) if preview else [rank]
+    for k, pixels in progressive(reconstructor, rank, ranks):
+        caption = label if k == rank else f"{label} (preview at rank {k} of {rank})"
+        placeholder.image(pixels, caption=caption, use_column_width=True)
+    return pixels
+
+
+@st.cache_data(max_entries=64, ttl=CACHE_TTL, show_spinner=False)
+def encode_download(result_key, rank, fmt, quality, _pixels):
+    return encode_image(_pixels, fmt=fmt, quality=quality)
+
+
+@st.cache_data(max_entries=64, ttl=CACHE_TTL, show_spinner=False)
+def encode_factors(result_key, rank, _factors):
+    return svdz.dumps(_factors, rank, progressive=True)
+
+
+def get_spectrum(factors, slot):
+    # Spectrum analytics are computed once per decomposition and shared by the rank selection and the figures.
+    # In YCbCr mode the rank is chosen on luma while the figures show all channels, hence one slot for each.
+    spectra = st.session_state.setdefault("spectra", {})
+    spectrum = next((s for s in spectra.values() if s.factors is factors), None)
+    if spectrum is None:
+        spectrum = Spectrum(factors)
+    spectra[slot] = spectrum
+    return spectrum
+
+
+def get_spectrum_figures(factors):
+    # Figures are built once per decomposition, slider moves only redraw the rank markers
+    figures = st.session_state.get("spectrum_figures")
+    if figures is None or figures.spectrum.factors is not factors:
+        styles = YCBCR_CHANNELS if hasattr(factors, "luma") else None
+        figures = st.session_state["spectrum_figures"] = SpectrumFigures(get_spectrum(factors, "figures"), styles=styles)
+    return figures
+
+
+def get_accuracy_report(decomposer, img, factors):
+    # The report runs the exact SVD the truncated engine avoids, so it is computed once per decomposition
+    report = st.session_state.get("accuracy_report")
+    if report is None or report[0] is not factors:
+        report = st.session_state["accuracy_report"] = (factors, decomposer.accuracy_report(img, factors))
+    return report[1]
+
 
 st.markdown('<h1 style="text-align: center;"><i class="fa-solid fa-angle-down"></i> &nbspImageSVD </h1>', unsafe_allow_html=True)
 st.markdown("<h4 style='text-align: center;'><i>Your Image Compression Solution</i></h2>", unsafe_allow_html=True)
@@ -30,40 +217,86 @@ st.markdown('')
 image = st.file_uploader("**SELECT AN IMAGE**", type=['jpg'], help="Images > 1MB require considerable time for compression with our current resources. Please hang tight!")
 st.markdown('')
 st.markdown('')
+ENGINE_LABELS = {"Exact": "exact", "Truncated (faster)": "randomized", "Tiled (large images)": "tiled"}
+engine = ENGINE_LABELS[st.radio(
+    "**DECOMPOSITION**", list(ENGINE_LABELS), horizontal=True,
+    help="The truncated engine only computes the top singular values with a randomized SVD, which is much faster for large images. "
+         "The tiled engine decomposes blocks of the image independently on every CPU core.")]
+max_rank = None
+tile_size = 512
+tile_budget = "uniform"
+if engine == "randomized":
+    max_rank = st.number_input("**MAXIMUM RANK**", min_value=2, max_value=2000, value=200, step=10,
+                               help="Number of singular values computed. The rank slider cannot go beyond this.")
+elif engine == "tiled":
+    tile_size = st.select_slider("**TILE SIZE**", options=[64, 128, 256, 512, 1024], value=256,
+                                 help="The rank slider applies to every tile, so smaller tiles need lower ranks.")
+    TILE_BUDGET_LABELS = {"Same rank for every tile": "uniform", "More rank for busy tiles": "energy"}
+    tile_budget = TILE_BUDGET_LABELS[st.radio(
+        "**RANK PER TILE**", list(TILE_BUDGET_LABELS), horizontal=True,
+        help="Spends the same total number of terms, but gives detailed tiles more of them than flat ones such as sky.")]
+COLOR_MODE_LABELS = {"RGB": "rgb", "YCbCr (smaller)": "ycbcr"}
+color_mode = COLOR_MODE_LABELS[st.radio(
+    "**COLOR MODE**", list(COLOR_MODE_LABELS), horizontal=True,
+    help="YCbCr keeps brightness at full resolution and stores the color at half resolution with a lower rank, "
+         "like JPEG does. Grayscale images ignore this.")]
+chroma_ratio = 0.5
+if color_mode == "ycbcr":
+    chroma_ratio = st.slider("**CHROMA RANK (% OF THE RANK)**", min_value=10, max_value=100, value=50, step=5,
+                             help="The eye is less sensitive to color detail, so the color channels can use a lower rank.") / 100
+single_precision = st.toggle("**Single precision**",
+                             help="Keep the factors and rebuild the image in float32. Halves the memory of the factors and speeds up the reconstruction, "
+                                  "with at most one grey level of difference.")
+dtype = np.float32 if single_precision else np.float64
+st.markdown('')
+st.markdown('')
 
-if image is not None:
-    pil_img = Image.open(image)
-    img = np.array(pil_img)
+waiting_for_full_resolution = False
+if image is None:
+    # Nothing uploaded (anymore), so nothing of the last upload needs to stay in the session
+    drop_full_resolution_job()
+    for name in ("upload", "reconstructor", "rank_factors", "spectra", "spectrum_figures", "accuracy_report", "image_file", "factor_file"):
+        st.session_state.pop(name, None)
+else:
+    # Memory tracing slows allocations down, so it is only on while the Advanced Info panel is open
+    profiler = Profiler(trace_memory=st.session_state.get("advanced_info", False),
+                        logger=stage_logger() if STAGE_LOG else None)
+    with profiler.stage("decode"):
+        upload_key, pil_img, img = get_upload(image)
     
-    decomposer = Decompose(img=img)
-
-    if decomposer.dimensions == 2:
-        U, S, Vt = decomposer.svd_grayscale_img(img)
-
-        compressed_image = decomposer.low_rank_approx(U=U, S=S, Vt=Vt).astype(np.uint8)
-
-        compressed_image = Image.fromarray(compressed_image)
-        col1, col2 = st.columns(2)
-        with col1:
-            st.image(pil_img, caption="Original image", use_column_width=True)
-        with col2:
-            st.image(compressed_image, caption="Compressed Image", use_column_width=True)
-
-    elif decomposer.dimensions == 3:
-        r, g, b = decomposer.svd_color_img(img)
-
-        compressed_red = decomposer.low_rank_approx(U=r[0], S=r[1], Vt=r[2])
-        compressed_green = decomposer.low_rank_approx(U=g[0], S=g[1], Vt=g[2])
-        compressed_blue = decomposer.low_rank_approx(U=b[0], S=b[1], Vt=b[2])
-
-        compressed_image = np.clip(np.stack((compressed_red, compressed_green, compressed_blue), axis=-1), 0, 255).astype(np.uint8)
-
-        compressed_image = Image.fromarray(compressed_image)
+    try:
+        decomposer = Decompose(img=img, cache=get_factor_cache(), engine=engine, max_rank=max_rank,
+                               workers=os.cpu_count(), tile_size=tile_size, profiler=profiler, color_mode=color_mode,
+                               dtype=dtype, memory_limit=MEMORY_LIMIT_MB * 2**20 or None, content_key=upload_key)
+    except MemoryError as e:
+        st.error(f"{e}. Please upload a smaller image.", icon='⚠')
+        st.stop()
+    if decomposer.fallback:
+        st.info(f"{decomposer.fallback} to stay within the memory limit.")
+    # The memory limit may have picked another engine
+    engine, max_rank = decomposer.engine, decomposer.max_rank
+
+    preview = None
+    if decomposer.dimensions in (2, 3):
+        factors, preview = get_factors(decomposer, img)
+        waiting_for_full_resolution = preview is not None
+        if preview is not None:
+            # Rank selection and the plots work on the preview until the full resolution factors are ready
+            decomposer = preview
+        carry_rank(factors)
+        decomposer.rank = choose_rank(decomposer, factors)
+
+        options = {"chroma_ratio": chroma_ratio} if decomposer.dimensions == 3 and color_mode == "ycbcr" else {}
+        if hasattr(factors, "tiles"):
+            options = {"budget": tile_budget}
+        reconstructor, created = get_reconstructor(factors, dtype, **options)
+        label = "Compressed Image" if preview is None else f"Compressed Preview ({factors.shape[1]} x {factors.shape[0]})"
         col1, col2 = st.columns(2)
         with col1:
             st.image(pil_img, caption="Original image", use_column_width=True)
         with col2:
-            st.image(compressed_image, caption="Compressed Image", use_column_width=True)
+            with profiler.stage("reconstruct", rank=decomposer.rank, progressive=created):
+                compressed_pixels = show_compressed(st.empty(), reconstructor, decomposer.rank, preview=created, label=label)
     
     else:
         st.warning("Image not compatible with our system!", icon='⚠')
@@ -72,146 +305,101 @@ if image is not None:
     st.markdown('***')
     st.markdown('')
 
-    compressed_image.save("images/Compressed_Image.jpg", "JPEG")
-    with open("images/Compressed_Image.jpg", "rb") as file:
-        btn = st.download_button(
-            label="**Download Compressed Image**",
-            data=file,
-            file_name="Compressed_Image.jpg",
-            mime="image/jpg"
-        )
-
-    st.markdown('')
-    if st.toggle("**Advanced Info**"):
-        if decomposer.dimensions == 2:
-            st.markdown('')
-            st.markdown('')
-            st.markdown('### Singular Value Analysis')
-            st.markdown('')
-            with st.spinner("Plotting..."):
-                time.sleep(2)
-            fig1, ax = plt.subplots(1, 1, figsize=(12, 4))
-
-            ax.semilogy(S, color='orange')
-            ax.set_title("Singular Values")
-            ax.set_xlabel('$j$')
-            ax.set_ylabel('$log\sigma_j$')
-            ax.grid(alpha=0.2)
-
-            st.pyplot(fig=fig1)
-            
-            st.markdown('')
-            st.markdown("***Singular Values $\sigma_j$ in logarithmic scale vs. index of the singular values $j$***")
-            st.markdown("The above plots are displayed using a logarithmic scale on the y-axis (`semilogy()` function), which is useful for visualizing a wide range of values. Singular values represent the importance or weight of each singular vector in the decomposition. Singular values are typically ordered in descending order, so the first few singular values capture most of the data's variance, and the rest contribute less. This type of plot helps you see the relative differences between singular values more clearly, especially when there are significant variations in magnitude.")
-            st.markdown('')
-            st.markdown('***')
-
-            fig2, ax = plt.subplots(1, 1, figsize=(12, 4))
-
-            ax.plot(np.cumsum(S/np.sum(S)), color='orange')
-            ax.set_title('Singular Values: Cumulative Sum')
-            ax.set_xlabel('$j$')
-            ax.set_ylabel('Cumulative Sum')
-            ax.vlines(x=decomposer.rank, ymin=0, ymax=np.cumsum(S/np.sum(S))[decomposer.rank], color='magenta', linestyle='--')
-            ax.hlines(y=np.cumsum(S/np.sum(S))[decomposer.rank], xmin=0.0, xmax=decomposer.rank, color='magenta', linestyle='--')
-            ax.plot(decomposer.rank, np.cumsum(S/np.sum(S))[decomposer.rank], 'mo')
-            ax.text(
-                x=decomposer.rank + 10,
-                y=np.cumsum(S/np.sum(S))[decomposer.rank] - 0.05,
-                s=f"{round(np.cumsum(S/np.sum(S))[decomposer.rank]*100, 1)} %"
+    ycbcr = hasattr(factors, "luma")
+    if preview is not None:
+        st.info(f"Showing a {factors.shape[1]} x {factors.shape[0]} preview while the full {img.shape[1]} x {img.shape[0]} image "
+                "is decomposed in the background. It replaces the preview automatically, and the downloads appear then.")
+    else:
+        # Identifies the compressed result, so downloads are only encoded again when it actually changes
+        result_key = derived_key(upload_key, engine, max_rank, tile_size, tile_budget, single_precision, color_mode, chroma_ratio)
+        col1, col2 = st.columns(2)
+        with col1:
+            download_format = st.radio("**DOWNLOAD FORMAT**", list(FORMATS), horizontal=True)
+        with col2:
+            quality = st.slider("**QUALITY**", min_value=10, max_value=100, value=90, step=5, disabled=download_format == "PNG",
+                                help="Quality of the lossy formats. PNG is lossless.")
+        extension, mime = FORMATS[download_format]
+        # Encoding a large image takes longer than a slider move, so like the .svdz file below it is only built
+        # on request and offered until the result, the rank or the format changes
+        image_file = st.session_state.get("image_file")
+        download_key = (result_key, decomposer.rank, download_format, quality)
+        if image_file is None or image_file[0] != download_key:
+            image_file = None
+            if st.button("**Prepare Compressed Image**"):
+                with profiler.stage("image_encode", format=download_format):
+                    image_file = st.session_state["image_file"] = (
+                        download_key, encode_download(result_key, decomposer.rank, download_format, quality, compressed_pixels))
+        if image_file is not None:
+            st.download_button(
+                label="**Download Compressed Image**",
+                data=image_file[1],
+                file_name=f"Compressed_Image.{extension}",
+                mime=mime
             )
-            plt.grid(alpha=0.2)
-
-            st.pyplot(fig=fig2)
-
-            st.markdown('')
-            st.markdown("***Cumulative Sum (of squared Singular values per total sum of squared Singular Values) vs. index of the singular values $j$***")
-            st.markdown("This plot helps you understand the contribution of each singular value to the total variance or energy of the matrix. The cumulative sum curve shows how much of the total variance is captured by including the first $j$ singular values. If you were to draw a horizontal line at a certain value on the y-axis, the corresponding x-axis value would tell you how many singular values you need to include to capture that percentage of the total variance and vice versa.")
-
-
-        elif decomposer.dimensions == 3:
-            st.markdown('')
-            st.markdown('')
-            st.markdown('### Singular Value Analysis')
-            st.markdown('')
-            with st.spinner("Plotting..."):
-                time.sleep(2)
-            fig1, ax = plt.subplots(1, 3, figsize=(18, 6))
-
-            ax[0].semilogy(r[1], color='red')
-            ax[0].set_title("Singular Values: Red Channel")
-            ax[0].set_xlabel('$j$')
-            ax[0].set_ylabel('$log\sigma_j$')
-            ax[0].grid(alpha=0.2)
-
-            ax[1].semilogy(g[1], color='green')
-            ax[1].set_title("Singular Values: Green Channel")
-            ax[1].set_xlabel('$j$')
-            ax[1].set_ylabel('$log\sigma_j$')
-            ax[1].grid(alpha=0.2)
-
-            ax[2].semilogy(b[1], color='blue')
-            ax[2].set_title("Singular Values: Blue Channel")
-            ax[2].set_xlabel('$j$')
-            ax[2].set_ylabel('$log\sigma_j$')
-            ax[2].grid(alpha=0.2)
-
-            st.pyplot(fig=fig1)
-
-            st.markdown('')
-            st.markdown("***Singular Values $\sigma_j$ in logarithmic scale vs. index of the singular values $j$***")
-            st.markdown("The above plots are displayed using a logarithmic scale on the y-axis (`semilogy()` function), which is useful for visualizing a wide range of values. Singular values represent the importance or weight of each singular vector in the decomposition. Singular values are typically ordered in descending order, so the first few singular values capture most of the data's variance, and the rest contribute less. This type of plot helps you see the relative differences between singular values more clearly, especially when there are significant variations in magnitude.")
-            st.markdown('')
-            st.markdown('***')
 
-            fig2, ax = plt.subplots(1, 3, figsize=(18, 6))
-
-            ax[0].plot(np.cumsum(r[1]/np.sum(r[1])), color='red')
-            ax[0].set_title('Singular Values [Red Channel]: Cumulative Sum')
-            ax[0].set_xlabel('$j$')
-            ax[0].set_ylabel('Cumulative Sum')
-            ax[0].vlines(x=decomposer.rank, ymin=0, ymax=np.cumsum(r[1]/np.sum(r[1]))[decomposer.rank], color='magenta', linestyle='--')
-            ax[0].hlines(y=np.cumsum(r[1]/np.sum(r[1]))[decomposer.rank], xmin=0.0, xmax=decomposer.rank, color='magenta', linestyle='--')
-            ax[0].plot(decomposer.rank, np.cumsum(r[1]/np.sum(r[1]))[decomposer.rank], 'mo')
-            ax[0].text(
-                x=decomposer.rank + 10,
-                y=np.cumsum(r[1]/np.sum(r[1]))[decomposer.rank] - 0.05,
-                s=f"{round(np.cumsum(r[1]/np.sum(r[1]))[decomposer.rank]*100, 1)} %"
-            )
-            ax[0].grid(alpha=0.2)
-
-            ax[1].plot(np.cumsum(g[1]/np.sum(g[1])), color='green')
-            ax[1].set_title('Singular Values [Green Channel]: Cumulative Sum')
-            ax[1].set_xlabel('$j$')
-            ax[1].set_ylabel('Cumulative Sum')
-            ax[1].vlines(x=decomposer.rank, ymin=0, ymax=np.cumsum(g[1]/np.sum(g[1]))[decomposer.rank], color='magenta', linestyle='--')
-            ax[1].hlines(y=np.cumsum(g[1]/np.sum(g[1]))[decomposer.rank], xmin=0.0, xmax=decomposer.rank, color='magenta', linestyle='--')
-            ax[1].plot(decomposer.rank, np.cumsum(g[1]/np.sum(g[1]))[decomposer.rank], 'mo')
-            ax[1].text(
-                x=decomposer.rank + 10,
-                y=np.cumsum(g[1]/np.sum(g[1]))[decomposer.rank] - 0.05,
-                s=f"{round(np.cumsum(g[1]/np.sum(g[1]))[decomposer.rank]*100, 1)} %"
-            )
-            ax[1].grid(alpha=0.2)
-
-            ax[2].plot(np.cumsum(b[1]/np.sum(b[1])), color='blue')
-            ax[2].set_title('Singular Values [Blue Channel]: Cumulative Sum')
-            ax[2].set_xlabel('$j$')
-            ax[2].set_ylabel('Cumulative Sum')
-            ax[2].vlines(x=decomposer.rank, ymin=0, ymax=np.cumsum(b[1]/np.sum(b[1]))[decomposer.rank], color='magenta', linestyle='--')
-            ax[2].hlines(y=np.cumsum(b[1]/np.sum(b[1]))[decomposer.rank], xmin=0.0, xmax=decomposer.rank, color='magenta', linestyle='--')
-            ax[2].plot(decomposer.rank, np.cumsum(b[1]/np.sum(b[1]))[decomposer.rank], 'mo')
-            ax[2].text(
-                x=decomposer.rank + 10,
-                y=np.cumsum(b[1]/np.sum(b[1]))[decomposer.rank] - 0.05,
-                s=f"{round(np.cumsum(b[1]/np.sum(b[1]))[decomposer.rank]*100, 1)} %"
-            )
-            ax[2].grid(alpha=0.2)
-            st.pyplot(fig=fig2)
+        # The image above re-encodes the pixels, the .svdz file stores the truncated factors themselves. Encoding
+        # it costs more than a slider move, so it is only built on request and offered until the result changes.
+        if engine != "tiled" and not ycbcr:
+            factor_file = st.session_state.get("factor_file")
+            if factor_file is None or factor_file[0] != (result_key, decomposer.rank):
+                factor_file = None
+                if st.button("**Prepare SVD Factors (.svdz)**", help="Stores the truncated factors themselves instead of the pixels."):
+                    with profiler.stage("svdz_encode"):
+                        factor_file = st.session_state["factor_file"] = (
+                            (result_key, decomposer.rank), encode_factors(result_key, decomposer.rank, factors))
+            if factor_file is not None:
+                report = svdz.compression_report(len(factor_file[1]), img.shape)
+                st.download_button(
+                    label="**Download SVD Factors (.svdz)**",
+                    data=factor_file[1],
+                    file_name="Compressed_Image.svdz",
+                    mime="application/octet-stream"
+                )
+                st.caption(f"{report['stored_bytes'] / 1024:.1f} KB of factors vs. {report['original_bytes'] / 1024:.1f} KB of raw pixels "
+                           f"({report['ratio']:.1f}x smaller, {report['bits_per_pixel']:.2f} bits per pixel)")
 
-            st.markdown('')
-            st.markdown("***Cumulative Sum (of squared Singular values per total sum of squared Singular Values) vs. index of the singular values $j$***")
-            st.markdown("This plot helps you understand the contribution of each singular value to the total variance or energy of the matrix. The cumulative sum curve shows how much of the total variance is captured by including the first $j$ singular values. If you were to draw a horizontal line at a certain value on the y-axis, the corresponding x-axis value would tell you how many singular values you need to include to capture that percentage of the total variance and vice versa.")
+    st.markdown('')
+    if st.toggle("**Advanced Info**", key="advanced_info"):
+        st.markdown('')
+        st.markdown('')
+        st.markdown('### Singular Value Analysis')
+        st.markdown('')
+        figures = get_spectrum_figures(factors)
+        with profiler.stage("plot_spectrum"):
+            st.image(figures.spectrum_png(), use_column_width=True)
+
+        st.markdown('')
+        st.markdown("***Singular Values $\sigma_j$ in logarithmic scale vs. index of the singular values $j$***")
+        st.markdown("The above plots are displayed using a logarithmic scale on the y-axis (`semilogy()` function), which is useful for visualizing a wide range of values. Singular values represent the importance or weight of each singular vector in the decomposition. Singular values are typically ordered in descending order, so the first few singular values capture most of the data's variance, and the rest contribute less. This type of plot helps you see the relative differences between singular values more clearly, especially when there are significant variations in magnitude.")
+        st.markdown('')
+        st.markdown('***')
+
+        with profiler.stage("plot_cumulative", rank=decomposer.rank):
+            st.image(figures.cumulative_png(decomposer.rank), use_column_width=True)
+
+        st.markdown('')
+        st.markdown("***Cumulative Sum (of squared Singular values per total sum of squared Singular Values) vs. index of the singular values $j$***")
+        st.markdown("This plot helps you understand the contribution of each singular value to the total variance or energy of the matrix. The cumulative sum curve shows how much of the total variance is captured by including the first $j$ singular values. If you were to draw a horizontal line at a certain value on the y-axis, the corresponding x-axis value would tell you how many singular values you need to include to capture that percentage of the total variance and vice versa.")
+
+        if ycbcr:
+            st.caption(f"Color channels use rank {reconstructor.chroma_rank(decomposer.rank)} at 1/{factors.subsampling} resolution, "
+                       "their singular values are scaled to the full image size.")
+
+        if engine == "randomized" and not ycbcr and preview is None:
+            st.markdown('***')
+            st.markdown('### Truncated SVD Accuracy')
+            st.table(dict(zip(channel_names(factors.channels), get_accuracy_report(decomposer, img, factors))))
+
+        st.markdown('***')
+        st.markdown('### Processing Time')
+        st.markdown('')
+        st.table([
+            {"Stage": r["stage"], "Wall time (ms)": f"{r['wall_ms']:.1f}", "CPU time (ms)": f"{r['cpu_ms']:.1f}",
+             "Peak memory (MB)": "-" if r["peak_mb"] is None else f"{r['peak_mb']:.1f}"}
+            for r in profiler.records
+        ])
+        st.caption(f"{profiler.total_ms:.0f} ms in total for this run. Stages missing from the table, such as the SVD, were served from the cache. "
+                   "Peak memory covers NumPy and Python allocations and is tracked from the run after this panel is opened.")
 
 st.markdown('')
 st.markdown('')
@@ -259,4 +447,10 @@ css_fa = '''
 </div>
 '''
 
-st.markdown(css_fa, unsafe_allow_html=True)
\ No newline at end of file
+st.markdown(css_fa, unsafe_allow_html=True)
+
+
+# Poll for the background decomposition. Any widget change interrupts the sleep with a new run.
+if waiting_for_full_resolution:
+    time.sleep(1)
+    st.rerun()
@@ -0,0 +1,319 @@
+"""
+Command-line batch compression on top of the processor.py engine.
+
+Examples:
+
+    python batch.py images/ -o compressed/ --rank 50
+    python batch.py --file-list photos.txt -o compressed/ --energy 0.99 --format svdz --workers 8
+    python batch.py images/ -o compressed/ --psnr 35
+    python batch.py frames/ -o compressed/ --rank 40 --sequence
+"""
+import argparse
+import os
+import sys
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+
+import numpy as np
+from PIL import Image
+
+import svdz
+from codec import encode_image
+from processor import COLOR_MODES, ENGINES, TILE_BUDGETS, Decompose
+from sequence import SequenceDecomposer
+
+
+EXTENSIONS = (".jpg", ".jpeg", ".png", ".bmp", ".tif", ".tiff", ".webp")
+FORMATS = {"jpg": "JPEG", "png": "PNG", "webp": "WEBP", "svdz": None}
+STAGES = ("decode", "svd", "reconstruct", "encode")
+
+
+def find_images(root):
+    """
+    A function to walk a directory and yield image paths in a stable order, without listing everything up front.
+
+    Parameters:
+    -----------
+    - root (str): Directory to search recursively.
+    """
+    for directory, subdirectories, files in os.walk(root):
+        subdirectories.sort()
+        for name in sorted(files):
+            if name.lower().endswith(EXTENSIONS):
+                yield os.path.join(directory, name)
+
+
+def read_file_list(path):
+    with open(path) as f:
+        for line in f:
+            line = line.strip()
+            if line and not line.startswith("#"):
+                yield line
+
+
+def output_path(path, root, output_dir, fmt):
+    relative = os.path.relpath(path, root) if root else os.path.basename(path)
+    return os.path.join(output_dir, os.path.splitext(relative)[0] + "." + fmt)
+
+
+def decode_image(file):
+    """
+    A function to decode an image file as a uint8 array, grayscale images as (H, W) and everything else as RGB.
+
+    Parameters:
+    -----------
+    - file (str or file object): The encoded image.
+    """
+    with Image.open(file) as pil_img:
+        return np.asarray(pil_img.convert("L" if pil_img.mode in ("L", "I", "I;16") else "RGB"))
+
+
+def compress_image(img, options, timings, sequence=None):
+    """
+    A function to compress a decoded image into the bytes of the output format and return (data, rank).
+
+    Parameters:
+    -----------
+    - img (array): The decoded image.
+    - options (dict): rank, energy or PSNR target, engine settings, output format and JPEG quality.
+    - timings (dict): Receives the time spent in the svd, reconstruct and encode stages.
+    - sequence (SequenceDecomposer): Decompose the image as the next frame of this sequence instead.
+    """
+    start = time.perf_counter()
+    decomposer = Decompose(img, engine=options["engine"], max_rank=options["max_rank"], tile_size=options["tile_size"],
+                           color_mode=options["color_mode"], dtype=options["dtype"], memory_limit=options["memory_limit"])
+    factors = decomposer.decompose(img) if sequence is None else sequence.decompose(img)
+    # YCbCr targets are measured on luma, chroma follows at a fixed fraction of its rank
+    target = getattr(factors, "luma", factors)
+    if options["energy"] is not None:
+        rank = decomposer.select_rank(target, options["energy"], metric="energy")
+    elif options["psnr"] is not None:
+        rank = decomposer.select_rank(target, options["psnr"], metric="psnr")
+    else:
+        rank = min(options["rank"], factors.max_rank)
+    timings["svd"] = time.perf_counter() - start
+
+    if options["format"] == "svdz":
+        timings["reconstruct"] = 0.0
+        start = time.perf_counter()
+        data = svdz.dumps(factors, rank)
+        timings["encode"] = time.perf_counter() - start
+    else:
+        start = time.perf_counter()
+        extra = {"budget": options["tile_budget"]} if hasattr(factors, "tiles") else {}
+        compressed = factors.reconstructor(dtype=options["dtype"], **extra).reconstruct(rank)
+        timings["reconstruct"] = time.perf_counter() - start
+
+        start = time.perf_counter()
+        data = encode_image(compressed, FORMATS[options["format"]], quality=options["quality"])
+        timings["encode"] = time.perf_counter() - start
+    return data, rank
+
+
+def compress_file(path, destination, options, sequence=None):
+    """
+    A function to compress one image and report how long each stage took. Runs inside a worker process.
+
+    Parameters:
+    -----------
+    - path (str): Image to compress.
+    - destination (str): Where the compressed file is written.
+    - options (dict): See `compress_image`.
+    - sequence (SequenceDecomposer): Decompose the image as the next frame of this sequence instead.
+    """
+    timings = {}
+    start = time.perf_counter()
+    img = decode_image(path)
+    timings["decode"] = time.perf_counter() - start
+
+    data, rank = compress_image(img, options, timings, sequence=sequence)
+    start = time.perf_counter()
+    os.makedirs(os.path.dirname(destination) or ".", exist_ok=True)
+    with open(destination, "wb") as f:
+        f.write(data)
+    timings["encode"] += time.perf_counter() - start
+
+    return {
+        "path": path,
+        "rank": rank,
+        "pixels": img.shape[0] * img.shape[1],
+        "input_bytes": os.path.getsize(path),
+        "output_bytes": len(data),
+        "timings": timings,
+    }
+
+
+def new_stats():
+    return {"images": 0, "failed": 0, "input_bytes": 0, "output_bytes": 0, "pixels": 0,
+            "timings": dict.fromkeys(STAGES, 0.0)}
+
+
+def add_result(stats, path, result, report):
+    # result is the dict returned by compress_file, or the exception it raised
+    if isinstance(result, Exception):
+        stats["failed"] += 1
+        report(f"FAILED {path}: {result}")
+        return
+    stats["images"] += 1
+    for key in ("input_bytes", "output_bytes", "pixels"):
+        stats[key] += result[key]
+    for stage, seconds in result["timings"].items():
+        stats["timings"][stage] += seconds
+    report(f"{path} -> rank {result['rank']}, {result['input_bytes'] / 1024:.0f} KB -> {result['output_bytes'] / 1024:.0f} KB")
+
+
+def run(jobs, options, workers, max_in_flight, report=print):
+    """
+    A function to compress (path, destination) jobs on a process pool with a bounded number of pending tasks.
+
+    Jobs are pulled lazily, so arbitrarily long directory walks never sit in memory as a whole.
+
+    Parameters:
+    -----------
+    - jobs (iterable): (path, destination) pairs.
+    - options (dict): See `compress_file`.
+    - workers (int): Size of the process pool.
+    - max_in_flight (int): Upper bound on submitted but unfinished jobs.
+    - report (callable): Called with one line per finished image.
+    """
+    stats = new_stats()
+    pending = {}
+    start = time.perf_counter()
+
+    def collect(future):
+        path = pending.pop(future)
+        try:
+            result = future.result()
+        except Exception as e:
+            result = e
+        add_result(stats, path, result, report)
+
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        for path, destination in jobs:
+            if len(pending) >= max_in_flight:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    collect(future)
+            pending[pool.submit(compress_file, path, destination, options)] = path
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                collect(future)
+
+    stats["wall_time"] = time.perf_counter() - start
+    return stats
+
+
+def run_sequence(jobs, options, rank, report=print):
+    """
+    A function to compress (path, destination) jobs in order as frames of one sequence, each frame warm-started
+    from the previous one. Frames depend on each other, so this runs in the calling process.
+
+    Parameters:
+    -----------
+    - jobs (iterable): (path, destination) pairs, in frame order.
+    - options (dict): See `compress_file`.
+    - rank (int): Factors computed per frame, the upper bound of the energy and PSNR targets.
+    - report (callable): Called with one line per finished frame.
+    """
+    stats = new_stats()
+    sequence = SequenceDecomposer(rank, cold_engine=options["engine"])
+    start = time.perf_counter()
+    for path, destination in jobs:
+        try:
+            result = compress_file(path, destination, options, sequence=sequence)
+        except Exception as e:
+            result = e
+        add_result(stats, path, result, report)
+    stats["wall_time"] = time.perf_counter() - start
+    stats["warm_frames"], stats["cold_frames"] = sequence.warm_frames, sequence.cold_frames
+    return stats
+
+
+def summary(stats):
+    wall = max(stats["wall_time"], 1e-9)
+    images = max(stats["images"], 1)
+    lines = [
+        f"{stats['images']} images compressed, {stats['failed']} failed in {stats['wall_time']:.2f} s",
+        f"{stats['images'] / wall:.2f} images/s, {stats['input_bytes'] / 2**20 / wall:.2f} MB/s in, "
+        f"{stats['pixels'] / 1e6 / wall:.2f} MPixel/s",
+        f"{stats['input_bytes'] / 2**20:.1f} MB in, {stats['output_bytes'] / 2**20:.1f} MB out",
+    ]
+    if "warm_frames" in stats:
+        lines.append(f"{stats['warm_frames']} frames warm-started, {stats['cold_frames']} decomposed from scratch")
+    lines.append("per-stage time (summed over workers, mean per image):")
+    for stage in STAGES:
+        seconds = stats["timings"][stage]
+        lines.append(f"  {stage:<12}{seconds:9.2f} s {1000 * seconds / images:9.1f} ms")
+    return "\n".join(lines)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Compress images with a truncated SVD.")
+    parser.add_argument("input", nargs="?", help="Directory of images to compress (searched recursively).")
+    parser.add_argument("--file-list", help="Text file with one image path per line, instead of a directory.")
+    parser.add_argument("-o", "--output-dir", required=True, help="Where compressed files are written.")
+    target = parser.add_mutually_exclusive_group()
+    target.add_argument("--rank", type=int, default=50, help="Number of singular values kept per channel.")
+    target.add_argument("--energy", type=float, help="Keep the smallest rank retaining this fraction of the energy.")
+    target.add_argument("--psnr", type=float, help="Keep the smallest rank reaching this PSNR in dB.")
+    parser.add_argument("--format", choices=list(FORMATS), default="jpg", help="Output format.")
+    parser.add_argument("--quality", type=int, default=90, help="Quality of the reconstructed image for JPEG and WebP.")
+    parser.add_argument("--engine", choices=ENGINES, default="exact", help="SVD engine.")
+    parser.add_argument("--max-rank", type=int,
+                        help="Factors computed by the randomized engine, per tile by the tiled engine and per frame with --sequence.")
+    parser.add_argument("--tile-size", type=int, default=512, help="Block size of the tiled engine.")
+    parser.add_argument("--tile-budget", choices=TILE_BUDGETS, default="uniform",
+                        help="energy gives busy tiles more of the rank than flat ones, for the same total number of terms.")
+    parser.add_argument("--color-mode", choices=COLOR_MODES, default="rgb",
+                        help="ycbcr stores color at half resolution and half the rank of the brightness.")
+    parser.add_argument("--single-precision", action="store_true", help="Keep the factors and rebuild in float32, which halves their memory.")
+    parser.add_argument("--memory-limit", type=int,
+                        help="Peak MB per image; larger images fall back to a truncated or tiled SVD, or fail.")
+    parser.add_argument("--sequence", action="store_true",
+                        help="Treat the images as frames of one video, in name order, and start each SVD from the previous frame.")
+    parser.add_argument("--workers", type=int, default=os.cpu_count(), help="Worker processes.")
+    parser.add_argument("--max-in-flight", type=int, help="Pending images at most (default: 2 per worker).")
+    parser.add_argument("-q", "--quiet", action="store_true", help="Only print the final summary.")
+    args = parser.parse_args(argv)
+    if (args.input is None) == (args.file_list is None):
+        parser.error("give either an input directory or --file-list")
+    if args.format == "svdz" and args.engine == "tiled":
+        parser.error("the tiled engine cannot be stored as .svdz")
+    if args.format == "svdz" and args.color_mode == "ycbcr":
+        parser.error("the ycbcr color mode cannot be stored as .svdz")
+    if args.sequence and (args.engine == "tiled" or args.color_mode == "ycbcr"):
+        parser.error("--sequence works with the exact or randomized engine in rgb color mode")
+    if (args.engine == "randomized" or args.sequence) and args.max_rank is None:
+        args.max_rank = args.rank if args.energy is None and args.psnr is None else 200
+    return args
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    options = {
+        "rank": args.rank, "energy": args.energy, "psnr": args.psnr, "format": args.format, "quality": args.quality,
+        "engine": args.engine, "max_rank": args.max_rank, "tile_size": args.tile_size, "color_mode": args.color_mode,
+        "tile_budget": args.tile_budget, "dtype": "float32" if args.single_precision else "float64",
+        "memory_limit": args.memory_limit * 2**20 if args.memory_limit else None,
+    }
+    if args.input:
+        root = args.input
+        paths = find_images(root)
+    else:
+        # Outputs keep the paths below the deepest common directory, so a/x.jpg and b/x.jpg do not collide
+        paths = list(read_file_list(args.file_list))
+        root = os.path.commonpath([os.path.dirname(os.path.abspath(path)) for path in paths]) if paths else None
+    jobs = ((path, output_path(path, root, args.output_dir, args.format)) for path in paths)
+    report = (lambda line: None) if args.quiet else print
+    if args.sequence:
+        stats = run_sequence(jobs, options, rank=args.max_rank, report=report)
+    else:
+        stats = run(jobs, options, workers=args.workers, max_in_flight=args.max_in_flight or 2 * args.workers,
+                    report=report)
+    print(summary(stats))
+    return 1 if stats["failed"] else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
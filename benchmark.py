@@ -0,0 +1,158 @@
+"""
+Reproducible benchmarks of the decomposition, reconstruction and encode paths.
+
+Results are written as JSON so runs from different commits can be compared:
+
+    python benchmark.py --output bench.json
+    python benchmark.py --sizes 512 1024 --repeat 3
+"""
+import argparse
+import io
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import time
+import tracemalloc
+
+import numpy as np
+from PIL import Image
+
+from processor import Decompose, Reconstructor
+
+
+BUNDLED_IMAGES = ("images/lenna.jpg", "images/Barbara.jpg")
+DEFAULT_SIZES = (256, 512, 1024, 2048)
+DEFAULT_RANKS = (10, 50, 200)
+
+
+def synthetic_image(size, seed=0):
+    """
+    A function to generate a deterministic photo-like RGB test image: smooth gradients, a few edges and some noise.
+
+    Parameters:
+    -----------
+    - size (int): Height and width of the image.
+    - seed (int): Seed of the noise.
+    """
+    rng = np.random.default_rng(seed)
+    y, x = np.mgrid[0:size, 0:size] / size
+    base = np.stack([128 + 100 * np.sin(6 * x + c) * np.cos(4 * y - c) for c in range(3)], axis=-1)
+    base[(x - 0.5)**2 + (y - 0.5)**2 < 0.05] += 60
+    base += rng.normal(0, 8, base.shape)
+    return np.clip(base, 0, 255).astype(np.uint8)
+
+
+def load_images(sizes):
+    images = {}
+    for path in BUNDLED_IMAGES:
+        with Image.open(path) as pil_img:
+            images[os.path.basename(path)] = np.asarray(pil_img.convert("RGB"))
+    for size in sizes:
+        images[f"synthetic-{size}"] = synthetic_image(size)
+    return images
+
+
+def measure(function, repeat):
+    """
+    A function to time a callable and record the peak memory it allocates.
+
+    Parameters:
+    -----------
+    - function (callable): The code to measure, called without arguments.
+    - repeat (int): Number of timed runs. Peak memory is taken from one extra, traced run.
+    """
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - start)
+    # Tracing slows allocations down, so it gets its own run instead of skewing the timings
+    tracemalloc.start()
+    function()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {"min_s": min(times), "median_s": statistics.median(times), "peak_bytes": peak}
+
+
+def bench_image(name, img, ranks, repeat, max_rank):
+    height, width = img.shape[:2]
+    megapixels = height * width / 1e6
+    results = []
+
+    def record(stage, function, **params):
+        result = measure(function, repeat)
+        result.update(image=name, stage=stage, height=height, width=width, params=params,
+                      megapixels_per_s=megapixels / result["min_s"] if result["min_s"] else None)
+        results.append(result)
+        return result
+
+    decomposer = Decompose(img)
+    record("decompose", lambda: decomposer.decompose(img), engine="exact")
+    single = Decompose(img, dtype=np.float32)
+    record("decompose", lambda: single.decompose(img), engine="exact", dtype="float32")
+    randomized = Decompose(img, engine="randomized", max_rank=max_rank)
+    record("decompose", lambda: randomized.decompose(img), engine="randomized", max_rank=max_rank)
+
+    factors = decomposer.decompose(img)
+    for rank in (r for r in ranks if r < factors.max_rank):
+        decomposer.rank = rank
+        channels = [decomposer.low_rank_approx(*factors[c]) for c in range(factors.channels)]
+        record("low_rank_approx", lambda: [decomposer.low_rank_approx(*factors[c]) for c in range(factors.channels)],
+               rank=rank)
+        record("stack_clip", lambda: np.clip(np.stack(channels, axis=-1), 0, 255).astype(np.uint8), rank=rank)
+        # Alternate between two neighbouring ranks, so every run does real work: a full rebuild when
+        # incremental updates are disabled, a single rank-one update otherwise
+        full = Reconstructor(factors, rebuild_ratio=0)
+        record("reconstruct", lambda: full.reconstruct(rank + 1 if full.current_rank == rank else rank), rank=rank)
+        reconstructor = Reconstructor(factors)
+        reconstructor.reconstruct(rank)
+        record("reconstruct_step", lambda: reconstructor.reconstruct(rank + 1 if reconstructor.current_rank == rank else rank),
+               rank=rank)
+
+        compressed = reconstructor.reconstruct(rank)
+        record("jpeg_encode", lambda: Image.fromarray(compressed).save(io.BytesIO(), "JPEG"), rank=rank)
+    return results
+
+
+def environment():
+    try:
+        commit = subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {
+        "commit": commit,
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the ImageSVD processing paths.")
+    parser.add_argument("--sizes", type=int, nargs="*", default=DEFAULT_SIZES, help="Sizes of the synthetic images.")
+    parser.add_argument("--ranks", type=int, nargs="*", default=DEFAULT_RANKS, help="Ranks used for reconstruction.")
+    parser.add_argument("--max-rank", type=int, default=100, help="Factors computed by the randomized engine.")
+    parser.add_argument("--repeat", type=int, default=5, help="Timed runs per measurement.")
+    parser.add_argument("--output", help="Write the JSON report here instead of standard output.")
+    args = parser.parse_args(argv)
+
+    results = []
+    for name, img in load_images(args.sizes).items():
+        print(f"benchmarking {name} {img.shape}", file=sys.stderr)
+        results.extend(bench_image(name, img, args.ranks, args.repeat, args.max_rank))
+
+    report = {"environment": environment(), "repeat": args.repeat, "results": results}
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,110 @@
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+
+import numpy as np
+
+
+def image_key(img, *extra):
+    """
+    A function to compute a content key for an image array.
+
+    Parameters:
+    -----------
+    - img (array): The decoded image.
+    - extra: Any additional hashable values that change the decomposition (e.g. engine settings).
+    """
+    img = np.ascontiguousarray(img)
+    digest = hashlib.blake2b(img.data, digest_size=16)
+    digest.update(f"{img.dtype.str}|{img.shape}|{extra}".encode())
+    return digest.hexdigest()
+
+
+def derived_key(key, *extra):
+    """
+    A function to combine a content key, e.g. of an uploaded file, with settings without touching the pixels again.
+
+    Parameters:
+    -----------
+    - key (str): Key identifying the image content.
+    - extra: Any additional hashable values that change the result.
+    """
+    return hashlib.blake2b(f"{key}|{extra}".encode(), digest_size=16).hexdigest()
+
+
+def _nbytes(value):
+    if hasattr(value, "nbytes"):
+        return int(value.nbytes)
+    if isinstance(value, (tuple, list)):
+        return sum(_nbytes(v) for v in value)
+    return 0
+
+
+class FactorCache:
+    def __init__(self, max_bytes, ttl=None) -> None:
+        """
+        A thread-safe LRU cache for SVD factors, bounded by the total size of the stored arrays.
+
+        Parameters:
+        -----------
+        - max_bytes (int): Memory budget for all cached entries. Least recently used entries are evicted first.
+        - ttl (float): Seconds an entry is kept after its last use, or None to keep it until it is evicted.
+          Expired entries are dropped on the next get or put.
+        """
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def _expire(self, now):
+        # Entries are kept in order of last use, so the expired ones are all at the front
+        while self.ttl is not None and self._entries:
+            key = next(iter(self._entries))
+            if now - self._entries[key][2] <= self.ttl:
+                break
+            self.nbytes -= self._entries.pop(key)[1]
+
+    def get(self, key):
+        with self._lock:
+            now = time.monotonic()
+            self._expire(now)
+            if key not in self._entries:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            value, size, _ = self._entries[key]
+            self._entries[key] = (value, size, now)
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        size = _nbytes(value)
+        with self._lock:
+            now = time.monotonic()
+            self._expire(now)
+            if key in self._entries:
+                self.nbytes -= self._entries.pop(key)[1]
+            # Entries larger than the whole budget are not worth evicting everything else for
+            if size > self.max_bytes:
+                return value
+            self._entries[key] = (value, size, now)
+            self.nbytes += size
+            while self.nbytes > self.max_bytes:
+                _, (_, evicted, _) = self._entries.popitem(last=False)
+                self.nbytes -= evicted
+        return value
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.nbytes = 0
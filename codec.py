@@ -0,0 +1,30 @@
+import io
+
+from PIL import Image
+
+
+# PIL format name -> (file extension, MIME type)
+FORMATS = {
+    "JPEG": ("jpg", "image/jpeg"),
+    "PNG": ("png", "image/png"),
+    "WEBP": ("webp", "image/webp"),
+}
+
+
+def encode_image(img, fmt="JPEG", quality=90):
+    """
+    A function to encode an image array into an in-memory file.
+
+    Parameters:
+    -----------
+    - img (uint8 array): The image, either (H, W) or (H, W, 3).
+    - fmt (str): "JPEG", "PNG" or "WEBP".
+    - quality (int): Quality of the lossy formats, from 1 to 100. PNG is lossless and ignores it.
+    """
+    if fmt not in FORMATS:
+        raise ValueError(f"Unknown image format {fmt!r}, expected one of {tuple(FORMATS)}")
+    buffer = io.BytesIO()
+    # PNG's optimize flag tries every filter and compression level, many times slower for a few percent
+    options = {} if fmt == "PNG" else {"quality": quality}
+    Image.fromarray(img).save(buffer, fmt, **options)
+    return buffer.getvalue()
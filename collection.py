@@ -0,0 +1,392 @@
+"""
+Compression of a collection of same-size images against one shared basis, 2D-PCA style.
+
+A left basis L (H x p) and a right basis R (W x q) are learnt from the whole collection, batch by batch, and
+every image is stored as its p x q coefficient matrix per channel, A ~ mean + L M R^T. The bases are stored once
+per collection instead of a U and Vt per image, and encoding a new image is two matrix products.
+
+    python collection.py build catalog/ -o catalog.svdc --rank 64
+    python collection.py build new-shots/ -o new-shots.svdc --basis catalog.svdc
+    python collection.py extract catalog.svdc shoes/0042.jpg -o 0042.png
+
+Layout of .svdc files (all little-endian):
+
+- header: magic b"SVDC", version, quantization, channels, height, width, p, q, number of images, index offset
+- mean image (C x H x W), L (H x p) and R (W x q) as float32
+- one fixed-size record per image: the C x p x q coefficients, int8/int16 records start with one float32 scale
+  per coefficient row. Image i starts at a known offset, so any image decodes without reading the others.
+- index: the image names as a JSON list
+"""
+import argparse
+import json
+import mmap
+import os
+import struct
+import sys
+import time
+
+import numpy as np
+
+from batch import decode_image, find_images, read_file_list
+from codec import encode_image
+from processor import channel_stack, psnr_from_mse
+
+
+MAGIC = b"SVDC"
+VERSION = 1
+HEADER = struct.Struct("<4sBBBxIIIIIQ")
+
+QUANTIZATIONS = {"float32": 0, "int16": 1, "int8": 2}
+_INTEGER_TYPES = {"int16": np.int16, "int8": np.int8}
+
+
+class CollectionBasis:
+    def __init__(self, shape, rank=64, cols=None) -> None:
+        """
+        Shared left and right bases of a collection of images, fitted incrementally with `partial_fit`.
+
+        The bases are the leading eigenvectors of the summed column and row covariances of all centered
+        channels, so fitting only keeps an H x H and a W x W matrix, whatever the size of the collection.
+
+        Parameters:
+        -----------
+        - shape (tuple): (H, W) or (H, W, C) of every image in the collection.
+        - rank (int): Number of left basis vectors p.
+        - cols (int): Number of right basis vectors q, the same as `rank` by default.
+        """
+        self.shape = tuple(shape)
+        height, width = self.shape[:2]
+        self.channels = 1 if len(self.shape) == 2 else self.shape[2]
+        self.p = min(rank, height)
+        self.q = min(rank if cols is None else cols, width)
+        self.count = 0
+        # Fitting state, only allocated by partial_fit so that decoding with a loaded basis does not pay for it
+        self._sum = self._rows = self._cols = None
+        self.mean = self.L = self.R = None
+
+    def partial_fit(self, images):
+        """
+        A function to add a batch of images to the covariances.
+
+        Parameters:
+        -----------
+        - images (list of arrays): Images of the collection's shape.
+        """
+        for img in images:
+            if img.shape != self.shape:
+                raise ValueError(f"Expected images of shape {self.shape}, got {img.shape}")
+        height, width = self.shape[:2]
+        if self._sum is None:
+            self._sum = np.zeros((self.channels, height, width))
+            self._rows = np.zeros((height, height))
+            self._cols = np.zeros((width, width))
+        for img in images:
+            stack = channel_stack(img).astype(np.float64)
+            self._sum += stack
+            # The channels side by side (H x CW) and on top of each other (CH x W), so the sums of A A^T and
+            # A^T A over the channels are one matrix product each
+            side_by_side = np.swapaxes(stack, 0, 1).reshape(height, -1)
+            self._rows += side_by_side @ side_by_side.T
+            stacked = stack.reshape(-1, width)
+            self._cols += stacked.T @ stacked
+        self.count += len(images)
+        return self
+
+    def fit(self):
+        """
+        A function to compute the mean image and the bases from the images added so far.
+        """
+        if not self.count:
+            raise ValueError("No images were added to the basis")
+        mean = self._sum / self.count
+        # Sum over the images of (A - M)^T (A - M) = sum of A^T A - n M^T M, per channel mean M
+        rows = self._rows - self.count * np.einsum("chw,cgw->hg", mean, mean)
+        cols = self._cols - self.count * np.einsum("chw,chv->wv", mean, mean)
+        self.L = np.linalg.eigh(rows)[1][:, ::-1][:, :self.p].astype(np.float32)
+        self.R = np.linalg.eigh(cols)[1][:, ::-1][:, :self.q].astype(np.float32)
+        self.mean = mean.astype(np.float32)
+        return self
+
+    @property
+    def nbytes(self):
+        return self.mean.nbytes + self.L.nbytes + self.R.nbytes
+
+    def encode(self, img):
+        """
+        A function to project an image onto the bases, returning its (C, p, q) coefficients.
+
+        Parameters:
+        -----------
+        - img (array): Image of the collection's shape.
+        """
+        if img.shape != self.shape:
+            raise ValueError(f"Expected an image of shape {self.shape}, got {img.shape}")
+        return self.L.T @ (channel_stack(img) - self.mean) @ self.R
+
+    def decode(self, coefficients):
+        """
+        A function to rebuild a uint8 image from its coefficients.
+
+        Parameters:
+        -----------
+        - coefficients (C x p x q array): See `encode`.
+        """
+        stack = self.L @ coefficients.astype(np.float32) @ self.R.T + self.mean
+        np.clip(stack, 0, 255, out=stack)
+        np.rint(stack, out=stack)
+        img = np.moveaxis(stack, 0, -1).astype(np.uint8)
+        return img[:, :, 0] if len(self.shape) == 2 else img
+
+
+def _record_size(channels, p, q, quantization):
+    if quantization == "float32":
+        return 4 * channels * p * q
+    size = 4 * channels * p + np.dtype(_INTEGER_TYPES[quantization]).itemsize * channels * p * q
+    # Keep every record 4-byte aligned for the scales of the next one
+    return size + -size % 4
+
+
+def _quantize(coefficients, quantization):
+    coefficients = np.ascontiguousarray(coefficients, dtype=np.float32)
+    if quantization == "float32":
+        return coefficients.tobytes()
+    dtype = _INTEGER_TYPES[quantization]
+    # The energy is concentrated in the first rows and columns, so each row gets its own scale
+    rows = coefficients.reshape(-1, coefficients.shape[-1])
+    scales = np.abs(rows).max(axis=1) / np.iinfo(dtype).max
+    scales[scales == 0] = 1
+    q = np.rint(rows / scales[:, np.newaxis]).astype(dtype)
+    return scales.astype(np.float32).tobytes() + q.tobytes()
+
+
+def _dequantize(buffer, offset, shape, quantization):
+    channels, p, q = shape
+    if quantization == "float32":
+        return np.frombuffer(buffer, dtype=np.float32, count=channels * p * q, offset=offset).reshape(shape)
+    scales = np.frombuffer(buffer, dtype=np.float32, count=channels * p, offset=offset)
+    values = np.frombuffer(buffer, dtype=_INTEGER_TYPES[quantization], count=channels * p * q,
+                           offset=offset + scales.nbytes).reshape(channels * p, q)
+    return (values * scales[:, np.newaxis]).reshape(shape)
+
+
+class CollectionWriter:
+    def __init__(self, file, basis, quantization="int8") -> None:
+        """
+        Writes an .svdc file image by image, so the collection never has to be held in memory.
+
+        Parameters:
+        -----------
+        - file (str): Destination path.
+        - basis (CollectionBasis): A fitted basis.
+        - quantization (str): "float32", "int16" or "int8" coefficients, the latter two with per-row scales.
+        """
+        if quantization not in QUANTIZATIONS:
+            raise ValueError(f"Unknown quantization {quantization!r}, expected one of {tuple(QUANTIZATIONS)}")
+        if basis.L is None:
+            raise ValueError("The basis has to be fitted first")
+        self.basis = basis
+        self.quantization = quantization
+        self.names = []
+        self._file = open(file, "wb")
+        # Header placeholder, rewritten by close once the number of images is known
+        self._write_header(0)
+        for array in (basis.mean, basis.L, basis.R):
+            self._file.write(np.ascontiguousarray(array, dtype=np.float32).tobytes())
+
+    def _write_header(self, index_offset):
+        height, width = self.basis.shape[:2]
+        self._file.write(HEADER.pack(MAGIC, VERSION, QUANTIZATIONS[self.quantization], self.basis.channels,
+                                     height, width, self.basis.p, self.basis.q, len(self.names), index_offset))
+
+    def add(self, name, img):
+        """
+        A function to encode and append one image, returning its coefficients as they will be decoded.
+
+        Parameters:
+        -----------
+        - name (str): Key of the image in the index, e.g. its relative path.
+        - img (array): Image of the collection's shape.
+        """
+        record = _quantize(self.basis.encode(img), self.quantization)
+        size = _record_size(self.basis.channels, self.basis.p, self.basis.q, self.quantization)
+        self._file.write(record + bytes(size - len(record)))
+        self.names.append(name)
+        return _dequantize(record, 0, (self.basis.channels, self.basis.p, self.basis.q), self.quantization)
+
+    def close(self):
+        index_offset = self._file.tell()
+        self._file.write(json.dumps(self.names).encode())
+        self._file.seek(0)
+        self._write_header(index_offset)
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class CollectionReader:
+    def __init__(self, file) -> None:
+        """
+        Random access to the images of an .svdc file, memory-mapped so only the requested records are read.
+
+        Parameters:
+        -----------
+        - file (str): Path of the .svdc file.
+        """
+        with open(file, "rb") as f:
+            self._buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, quantization, channels, height, width, p, q, count, index_offset = \
+            HEADER.unpack_from(self._buffer, 0)
+        if magic != MAGIC:
+            raise ValueError("Not an .svdc file")
+        if version != VERSION:
+            raise ValueError(f"Unsupported .svdc version {version}")
+        self.quantization = {code: name for name, code in QUANTIZATIONS.items()}[quantization]
+        self.count = count
+
+        offset = HEADER.size
+        arrays = []
+        for shape in ((channels, height, width), (height, p), (width, q)):
+            arrays.append(np.frombuffer(self._buffer, dtype=np.float32, count=int(np.prod(shape)),
+                                        offset=offset).reshape(shape))
+            offset += arrays[-1].nbytes
+        self.basis = CollectionBasis((height, width) if channels == 1 else (height, width, channels), p, q)
+        self.basis.mean, self.basis.L, self.basis.R = arrays
+        self._records = offset
+        self._record_size = _record_size(channels, p, q, self.quantization)
+        self.names = json.loads(self._buffer[index_offset:].decode())
+        self._positions = {name: i for i, name in enumerate(self.names)}
+
+    def __len__(self):
+        return self.count
+
+    def __contains__(self, name):
+        return name in self._positions
+
+    def coefficients(self, key):
+        """
+        A function to read the coefficients of one image.
+
+        Parameters:
+        -----------
+        - key (str or int): Name of the image in the index, or its position.
+        """
+        i = self._positions[key] if isinstance(key, str) else range(self.count)[key]
+        return _dequantize(self._buffer, self._records + i * self._record_size,
+                           (self.basis.channels, self.basis.p, self.basis.q), self.quantization)
+
+    def __getitem__(self, key):
+        return self.basis.decode(self.coefficients(key))
+
+
+def batches(items, size):
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def image_names(sources):
+    # (name, path) pairs, names relative to a source directory so they stay stable when the tree moves
+    for source in sources:
+        if os.path.isdir(source):
+            for path in find_images(source):
+                yield os.path.relpath(path, source), path
+        else:
+            yield os.path.basename(source), source
+
+
+def build(names, output, rank, cols=None, quantization="int8", batch_size=16, basis=None, report=print):
+    """
+    A function to fit a basis on a collection and write it as an .svdc file, in two passes over the images.
+
+    Parameters:
+    -----------
+    - names (list of (name, path) pairs): The images of the collection, see image_names.
+    - output (str): Path of the .svdc file.
+    - rank, cols (int): Size of the left and right bases, see CollectionBasis.
+    - quantization (str): See CollectionWriter.
+    - batch_size (int): Images decoded at once while fitting.
+    - basis (CollectionBasis): Fitted basis to reuse, which skips the first pass.
+    - report (callable): Receives one progress line at a time.
+    """
+    if basis is None:
+        start = time.perf_counter()
+        for batch in batches(names, batch_size):
+            images = [decode_image(path) for _, path in batch]
+            if basis is None:
+                basis = CollectionBasis(images[0].shape, rank, cols)
+            basis.partial_fit(images)
+            report(f"{basis.count} images added to the basis")
+        if basis is None:
+            raise ValueError("No images found")
+        basis.fit()
+        report(f"Basis of {basis.p} x {basis.q} fitted in {time.perf_counter() - start:.1f} s")
+
+    start = time.perf_counter()
+    errors = []
+    with CollectionWriter(output, basis, quantization=quantization) as writer:
+        for name, path in names:
+            img = decode_image(path)
+            rebuilt = basis.decode(writer.add(name, img))
+            errors.append(np.mean((rebuilt.astype(np.float64) - img)**2))
+    elapsed = time.perf_counter() - start
+    stored = os.path.getsize(output)
+    report(f"{len(errors)} images encoded in {elapsed:.1f} s ({1000 * elapsed / max(len(errors), 1):.1f} ms each), "
+           f"{stored / 2**20:.1f} MB stored, mean PSNR {psnr_from_mse(np.mean(errors)):.2f} dB")
+    return basis
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Compress a collection of same-size images against a shared basis.")
+    commands = parser.add_subparsers(dest="command", required=True)
+    build_parser = commands.add_parser("build", help="Fit a basis and encode every image into an .svdc file.")
+    build_parser.add_argument("inputs", nargs="*", help="Image files or directories, searched recursively.")
+    build_parser.add_argument("--file-list", help="Text file with one image path per line.")
+    build_parser.add_argument("-o", "--output", required=True, help="The .svdc file to write.")
+    build_parser.add_argument("--rank", type=int, default=64, help="Left basis vectors, and right ones unless --cols is given.")
+    build_parser.add_argument("--cols", type=int, help="Right basis vectors.")
+    build_parser.add_argument("--quantization", choices=list(QUANTIZATIONS), default="int8", help="Storage of the coefficients.")
+    build_parser.add_argument("--batch-size", type=int, default=16, help="Images decoded at once while fitting the basis.")
+    build_parser.add_argument("--basis", help="Reuse the basis of an existing .svdc file instead of fitting one.")
+    extract_parser = commands.add_parser("extract", help="Decode one image of an .svdc file.")
+    extract_parser.add_argument("collection", help="The .svdc file.")
+    extract_parser.add_argument("name", help="Name of the image in the index.")
+    extract_parser.add_argument("-o", "--output", required=True, help="Destination .jpg, .png or .webp file.")
+    commands.add_parser("list", help="List the images of an .svdc file.").add_argument("collection", help="The .svdc file.")
+    args = parser.parse_args(argv)
+
+    if args.command == "build":
+        if not args.inputs and not args.file_list:
+            parser.error("give image files, directories or --file-list")
+        names = list(image_names(args.inputs))
+        if args.file_list:
+            names += list(image_names(read_file_list(args.file_list)))
+        basis = CollectionReader(args.basis).basis if args.basis else None
+        build(names, args.output, args.rank, cols=args.cols, quantization=args.quantization,
+              batch_size=args.batch_size, basis=basis)
+    elif args.command == "extract":
+        reader = CollectionReader(args.collection)
+        if args.name not in reader:
+            print(f"No image {args.name!r} in {args.collection}", file=sys.stderr)
+            return 1
+        fmt = {"jpg": "JPEG", "jpeg": "JPEG", "png": "PNG", "webp": "WEBP"}.get(os.path.splitext(args.output)[1][1:].lower())
+        if fmt is None:
+            parser.error("the output must be a .jpg, .png or .webp file")
+        with open(args.output, "wb") as f:
+            f.write(encode_image(reader[args.name], fmt))
+    else:
+        reader = CollectionReader(args.collection)
+        print("\n".join(reader.names))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
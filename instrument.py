@@ -0,0 +1,90 @@
+import json
+import logging
+import time
+import tracemalloc
+from contextlib import contextmanager, nullcontext
+
+
+class Profiler:
+    def __init__(self, trace_memory=False, logger=None) -> None:
+        """
+        Records wall time, CPU time and (optionally) peak Python/NumPy allocation of named stages.
+
+        Parameters:
+        -----------
+        - trace_memory (bool): Track peak allocation with tracemalloc. This slows every allocation down and the
+          tracer is shared by the whole process, so peaks overlap when several sessions run at once.
+        - logger (logging.Logger): If given, every stage is also logged as one JSON object.
+        """
+        self.trace_memory = trace_memory
+        self.logger = logger
+        self.records = []
+
+    @contextmanager
+    def stage(self, name, **fields):
+        """
+        A context manager timing the code inside it as one stage.
+
+        Parameters:
+        -----------
+        - name (str): Name of the stage.
+        - fields: Extra values stored with the record, e.g. the rank.
+        """
+        started_tracing = self.trace_memory and not tracemalloc.is_tracing()
+        if started_tracing:
+            tracemalloc.start()
+        elif self.trace_memory:
+            tracemalloc.reset_peak()
+        wall = time.perf_counter()
+        # Process CPU time, so work done by BLAS/LAPACK threads is included
+        cpu = time.process_time()
+        try:
+            yield
+        finally:
+            record = {
+                "stage": name,
+                "wall_ms": 1000 * (time.perf_counter() - wall),
+                "cpu_ms": 1000 * (time.process_time() - cpu),
+                "peak_mb": tracemalloc.get_traced_memory()[1] / 2**20 if self.trace_memory else None,
+                **fields,
+            }
+            if started_tracing:
+                tracemalloc.stop()
+            self.records.append(record)
+            if self.logger is not None:
+                self.logger.info(json.dumps(record))
+
+    @property
+    def total_ms(self):
+        return sum(record["wall_ms"] for record in self.records)
+
+
+def stage(profiler, name, **fields):
+    """
+    A function returning the profiler's stage context, or a no-op one when there is no profiler.
+
+    Parameters:
+    -----------
+    - profiler (Profiler or None): Where the stage is recorded.
+    - name (str): Name of the stage.
+    """
+    if profiler is None:
+        return nullcontext()
+    return profiler.stage(name, **fields)
+
+
+def stage_logger(enabled=True):
+    """
+    A function returning the logger for stage records, writing one JSON line per stage to stderr when enabled.
+
+    Parameters:
+    -----------
+    - enabled (bool): Attach a stderr handler if the logger has none yet.
+    """
+    logger = logging.getLogger("imagesvd.stages")
+    if enabled and not logger.handlers:
+        handler = logging.StreamHandler()
+        handler.setFormatter(logging.Formatter("%(message)s"))
+        logger.addHandler(handler)
+        logger.setLevel(logging.INFO)
+    return logger
@@ -0,0 +1,237 @@
+"""
+Out-of-core truncated SVD of images larger than memory, read as memory-mapped row strips.
+
+The image is a .npy file of shape (H, W) or (H, W, C), so it can be memory-mapped instead of decoded. Only a
+few row strips, the (k x W) right factors and some k x k matrices are held in memory, whatever the height.
+U is written strip by strip to a .npy file next to the other factors:
+
+    python outofcore.py huge.npy --rank 100 -o factors/
+    python outofcore.py huge.npy --rank 100 -o factors/ --svdz huge.svdz --reconstruct preview.npy
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+import svdz
+from processor import Factors, channel_stack
+
+
+METHODS = ("sketch", "gram")
+
+
+def open_image(path):
+    """
+    A function to memory-map a .npy image without reading it.
+
+    Parameters:
+    -----------
+    - path (str): A .npy file of shape (H, W) or (H, W, C).
+    """
+    img = np.load(path, mmap_mode="r")
+    if img.ndim not in (2, 3):
+        raise ValueError(f"Expected an (H, W) or (H, W, C) image, got shape {img.shape}")
+    return img
+
+
+def strips(height, rows):
+    for start in range(0, height, rows):
+        yield slice(start, min(start + rows, height))
+
+
+def _read(img, rows, dtype):
+    # (C, rows, W) float copy of one strip, the only place the image itself is read
+    return channel_stack(np.asarray(img[rows])).astype(dtype)
+
+
+def _solve_right(Y, R):
+    # Y R^-1 for the batch of upper triangular R, i.e. the orthonormal factor of CholeskyQR
+    return np.swapaxes(np.linalg.solve(np.swapaxes(R, -1, -2), np.swapaxes(Y, -1, -2)), -1, -2)
+
+
+def _cholesky_r(G):
+    # Upper triangular R with R^T R = G. A tiny shift keeps rank deficient strips (flat images) factorizable.
+    shift = 1e-13 * np.trace(G, axis1=-2, axis2=-1)[..., np.newaxis, np.newaxis] + np.finfo(G.dtype).tiny
+    return np.swapaxes(np.linalg.cholesky(G + shift * np.eye(G.shape[-1])), -1, -2)
+
+
+def _sketch(img, rank, U, oversample, n_iter, rows, seed, dtype, workdir):
+    height, width = img.shape[:2]
+    channels = 1 if img.ndim == 2 else img.shape[2]
+    sketch = min(rank + oversample, height, width)
+    rng = np.random.default_rng(seed)
+    P, _ = np.linalg.qr(rng.standard_normal((channels, width, sketch)))
+    # The range sample Y = A P is as tall as the image, so it lives on disk next to U
+    Y = np.lib.format.open_memmap(os.path.join(workdir, "sample.npy"), mode="w+", dtype=dtype,
+                                  shape=(channels, height, sketch))
+    total_energy = np.zeros(channels)
+
+    for iteration in range(n_iter + 1):
+        # Pass over the image: Y = A P and its Gram matrix
+        G = np.zeros((channels, sketch, sketch))
+        for r in strips(height, rows):
+            A = _read(img, r, dtype)
+            if iteration == 0:
+                total_energy += np.einsum("chw,chw->c", A, A, dtype=np.float64)
+            Y[:, r] = A @ P
+            G += np.swapaxes(Y[:, r], -1, -2) @ Y[:, r]
+        # CholeskyQR2: a second, cheap pass over Y restores orthogonality lost to the squared condition number
+        R = _cholesky_r(G)
+        G = np.zeros_like(G)
+        for r in strips(height, rows):
+            Q = _solve_right(Y[:, r], R)
+            G += np.swapaxes(Q, -1, -2) @ Q
+        R = _cholesky_r(G) @ R
+        # Pass over the image: B = Q^T A
+        B = np.zeros((channels, sketch, width))
+        for r in strips(height, rows):
+            B += np.swapaxes(_solve_right(Y[:, r], R), -1, -2) @ _read(img, r, dtype)
+        if iteration < n_iter:
+            # Power iteration, orthonormalised in memory since B^T is only W x sketch
+            P, _ = np.linalg.qr(np.swapaxes(B, -1, -2))
+
+    U_small, S, Vt = np.linalg.svd(B, full_matrices=False)
+    k = min(rank, sketch)
+    for r in strips(height, rows):
+        U[:, r] = _solve_right(Y[:, r], R) @ U_small[..., :k]
+    del Y
+    return S[:, :k], Vt[:, :k], total_energy
+
+
+def _gram(img, rank, U, rows, dtype):
+    height, width = img.shape[:2]
+    channels = 1 if img.ndim == 2 else img.shape[2]
+    # One pass for A^T A (W x W per channel), whose eigenvectors are the right singular vectors
+    G = np.zeros((channels, width, width))
+    for r in strips(height, rows):
+        A = _read(img, r, dtype)
+        G += np.swapaxes(A, -1, -2) @ A
+    total_energy = np.trace(G, axis1=-2, axis2=-1)
+    values, vectors = np.linalg.eigh(G)
+    k = min(rank, height, width)
+    S = np.sqrt(np.maximum(values[:, ::-1][:, :k], 0))
+    Vt = np.swapaxes(vectors[:, :, ::-1][:, :, :k], -1, -2)
+    # Second pass: U = A V / S, strip by strip
+    scale = np.divide(1.0, S, out=np.zeros_like(S), where=S > 0)[:, np.newaxis, :]
+    V = np.swapaxes(Vt, -1, -2)
+    for r in strips(height, rows):
+        U[:, r] = (_read(img, r, dtype) @ V) * scale
+    return S, Vt, total_energy
+
+
+def streaming_svd(img, rank, u_path, method="sketch", oversample=10, n_iter=2, rows=256, seed=0, dtype=np.float64):
+    """
+    A function to compute the top singular triplets of every channel of a memory-mapped image, strip by strip.
+
+    "sketch" is a randomized range finder: 2 * (n_iter + 1) passes over the image, memory independent of both
+    height and width apart from the k x W right factors. "gram" accumulates A^T A in one pass and writes U in a
+    second. It needs W x W memory per channel and squares the condition number, so it is less accurate for the
+    smaller singular values, but it reads the image only twice.
+
+    Parameters:
+    -----------
+    - img (array): Memory-mapped (H, W) or (H, W, C) image, see open_image.
+    - rank (int): Number of singular triplets per channel.
+    - u_path (str): .npy file that receives U as a (C, H, rank) array.
+    - method (str): "sketch" or "gram".
+    - oversample (int): Extra directions sampled by the sketch.
+    - n_iter (int): Power iterations of the sketch, each one costs two more passes over the image.
+    - rows (int): Height of the strips, which bounds the memory used for the image.
+    - seed (int): Seed of the sketch's random test matrix.
+    - dtype (type): Working precision of the strips and of U.
+    """
+    if method not in METHODS:
+        raise ValueError(f"Unknown method {method!r}, expected one of {METHODS}")
+    height, width = img.shape[:2]
+    channels = 1 if img.ndim == 2 else img.shape[2]
+    k = min(rank, height, width)
+    U = np.lib.format.open_memmap(u_path, mode="w+", dtype=dtype, shape=(channels, height, k))
+    if method == "gram":
+        S, Vt, total_energy = _gram(img, rank, U, rows, dtype)
+    else:
+        with tempfile.TemporaryDirectory(dir=os.path.dirname(os.path.abspath(u_path))) as workdir:
+            S, Vt, total_energy = _sketch(img, rank, U, oversample, n_iter, rows, seed, dtype, workdir)
+    U.flush()
+    return Factors(U, S.astype(dtype), Vt.astype(dtype), total_energy)
+
+
+def save_factors(factors, directory):
+    # U is already on disk, S, Vt and the energy are small
+    np.save(os.path.join(directory, "S.npy"), factors.S)
+    np.save(os.path.join(directory, "Vt.npy"), factors.Vt)
+    np.save(os.path.join(directory, "total_energy.npy"), factors.total_energy)
+
+
+def load_factors(directory):
+    """
+    A function to open factors written by this module, with U memory-mapped.
+
+    Parameters:
+    -----------
+    - directory (str): Directory holding U.npy, S.npy, Vt.npy and total_energy.npy.
+    """
+    return Factors(np.load(os.path.join(directory, "U.npy"), mmap_mode="r"),
+                   np.load(os.path.join(directory, "S.npy")),
+                   np.load(os.path.join(directory, "Vt.npy")),
+                   np.load(os.path.join(directory, "total_energy.npy")))
+
+
+def reconstruct_strips(factors, rank, out, rows=256):
+    """
+    A function to write the rank-k approximation into a (memory-mapped) uint8 array, one strip at a time.
+
+    Parameters:
+    -----------
+    - factors (Factors): Factors with U possibly memory-mapped.
+    - rank (int): Number of singular values used.
+    - out (uint8 array): Destination of shape (H, W) or (H, W, C), e.g. from np.lib.format.open_memmap.
+    - rows (int): Height of the strips.
+    """
+    height, _ = factors.shape
+    channels = out if out.ndim == 3 else out[:, :, np.newaxis]
+    # S folded into Vt once, so each strip is a single batched matmul
+    SVt = factors.S[:, :rank, np.newaxis] * factors.Vt[:, :rank]
+    for r in strips(height, rows):
+        block = np.asarray(factors.U[:, r, :rank]) @ SVt
+        np.clip(block, 0, 255, out=block)
+        np.rint(block, out=block)
+        np.copyto(channels[r], np.moveaxis(block, 0, -1), casting="unsafe")
+    return out
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Truncated SVD of a .npy image larger than memory.")
+    parser.add_argument("image", help="(H, W) or (H, W, C) uint8 image saved with numpy.save.")
+    parser.add_argument("--rank", type=int, default=100, help="Singular triplets computed per channel.")
+    parser.add_argument("-o", "--output-dir", required=True, help="Where U.npy, S.npy and Vt.npy are written.")
+    parser.add_argument("--method", choices=METHODS, default="sketch", help="Streaming randomized sketch or Gram matrix.")
+    parser.add_argument("--n-iter", type=int, default=2, help="Power iterations of the sketch, two passes over the image each.")
+    parser.add_argument("--rows", type=int, default=256, help="Height of the row strips read at once.")
+    parser.add_argument("--single-precision", action="store_true", help="Work in float32 and store U as float32.")
+    parser.add_argument("--svdz", help="Also write the factors as an .svdz file.")
+    parser.add_argument("--reconstruct", help="Also write the rank-k image to this .npy file.")
+    args = parser.parse_args(argv)
+
+    img = open_image(args.image)
+    os.makedirs(args.output_dir, exist_ok=True)
+    start = time.perf_counter()
+    factors = streaming_svd(img, args.rank, os.path.join(args.output_dir, "U.npy"), method=args.method,
+                            n_iter=args.n_iter, rows=args.rows,
+                            dtype=np.float32 if args.single_precision else np.float64)
+    save_factors(factors, args.output_dir)
+    print(f"{img.shape} decomposed to rank {factors.max_rank} in {time.perf_counter() - start:.1f} s, "
+          f"{factors.nbytes / 2**20:.1f} MB of factors")
+    if args.svdz:
+        print(f"{svdz.save(args.svdz, factors, factors.max_rank, progressive=True) / 2**20:.1f} MB written to {args.svdz}")
+    if args.reconstruct:
+        out = np.lib.format.open_memmap(args.reconstruct, mode="w+", dtype=np.uint8, shape=img.shape)
+        reconstruct_strips(factors, factors.max_rank, out, rows=args.rows)
+        out.flush()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -20,7 +20,9 @@ st.markdown("""
     **Data Retention**
 
     We respect your privacy and are committed to retaining your image data only for the necessary duration required
-    to complete the requested tasks. Your image data will be automatically and securely deleted from our systems when you exit the session.
+    to complete the requested tasks. Your images and the results computed from them are only held in memory and never written to disk.
+    To keep moving the rank slider fast, the decomposition of an image and the prepared downloads are kept for at most 10 minutes
+    after they were last used and are then deleted automatically, even if you have already left the session.
 
     **Data Security**
 
@@ -0,0 +1,115 @@
+import io
+from collections import OrderedDict
+
+from matplotlib.figure import Figure
+
+
+CHANNELS = {
+    1: [(None, "orange")],
+    3: [("Red", "red"), ("Green", "green"), ("Blue", "blue")],
+    4: [("Red", "red"), ("Green", "green"), ("Blue", "blue"), ("Alpha", "grey")],
+}
+YCBCR_CHANNELS = [("Luma", "black"), ("Blue Chroma", "blue"), ("Red Chroma", "red")]
+
+
+def channel_styles(channels):
+    return CHANNELS.get(channels, [(f"Channel {c}", "grey") for c in range(channels)])
+
+
+def channel_names(channels):
+    return [name or "Gray" for name, _ in channel_styles(channels)]
+
+
+class SpectrumFigures:
+    def __init__(self, spectrum, dpi=100, max_cached=32, styles=None) -> None:
+        """
+        Renders the singular value plots of one decomposition. Figures are built once; moving the rank only
+        moves the rank markers, and rendered images are kept for recently used ranks.
+
+        Parameters:
+        -----------
+        - spectrum (Spectrum): Precomputed spectrum analytics of the decomposition.
+        - dpi (int): Resolution of the rendered PNGs.
+        - max_cached (int): Number of rendered cumulative plots kept, one per rank.
+        - styles (list): Optional (name, color) per channel, by default picked from the number of channels.
+        """
+        self.spectrum = spectrum
+        self.dpi = dpi
+        self.max_cached = max_cached
+        self.channels = styles or channel_styles(spectrum.S.shape[0])
+        self._spectrum_png = None
+        self._cumulative = None
+        self._cumulative_png = OrderedDict()
+
+    def _figure(self):
+        # Figure objects instead of pyplot, so nothing is registered in pyplot's global figure manager
+        if len(self.channels) == 1:
+            fig = Figure(figsize=(12, 4))
+            return fig, [fig.subplots(1, 1)]
+        fig = Figure(figsize=(6 * len(self.channels), 6))
+        return fig, list(fig.subplots(1, len(self.channels)))
+
+    def _render(self, fig):
+        buffer = io.BytesIO()
+        fig.savefig(buffer, format="png", dpi=self.dpi, bbox_inches="tight")
+        return buffer.getvalue()
+
+    def spectrum_png(self):
+        """
+        A function returning the log-scale plot of the singular values, which does not depend on the rank.
+        """
+        if self._spectrum_png is None:
+            fig, axes = self._figure()
+            points = self.spectrum.points
+            for ax, S, (name, color) in zip(axes, self.spectrum.S, self.channels):
+                ax.semilogy(points, S[points], color=color)
+                ax.set_title("Singular Values" if name is None else f"Singular Values: {name} Channel")
+                ax.set_xlabel('$j$')
+                ax.set_ylabel(r'$log\sigma_j$')
+                ax.grid(alpha=0.2)
+            self._spectrum_png = self._render(fig)
+        return self._spectrum_png
+
+    def _build_cumulative(self):
+        fig, axes = self._figure()
+        points = self.spectrum.rank_points
+        markers = []
+        for ax, cumulative, (name, color) in zip(axes, self.spectrum.cumulative_energy, self.channels):
+            ax.plot(points, cumulative[points], color=color)
+            ax.set_title('Singular Values: Cumulative Sum' if name is None else f'Singular Values [{name} Channel]: Cumulative Sum')
+            ax.set_xlabel('$j$')
+            ax.set_ylabel('Cumulative Sum')
+            ax.grid(alpha=0.2)
+            vline, = ax.plot([], [], color='magenta', linestyle='--')
+            hline, = ax.plot([], [], color='magenta', linestyle='--')
+            dot, = ax.plot([], [], 'mo')
+            text = ax.text(0, 0, "")
+            markers.append((vline, hline, dot, text))
+        return fig, markers
+
+    def cumulative_png(self, rank):
+        """
+        A function returning the cumulative energy plot with the given rank marked.
+
+        Parameters:
+        -----------
+        - rank (int): Rank of the current approximation.
+        """
+        if rank in self._cumulative_png:
+            self._cumulative_png.move_to_end(rank)
+            return self._cumulative_png[rank]
+        if self._cumulative is None:
+            self._cumulative = self._build_cumulative()
+        fig, markers = self._cumulative
+        offset = max(1, self.spectrum.S.shape[1] // 50)
+        for (vline, hline, dot, text), cumulative in zip(markers, self.spectrum.cumulative_energy):
+            y = cumulative[rank]
+            vline.set_data([rank, rank], [0, y])
+            hline.set_data([0, rank], [y, y])
+            dot.set_data([rank], [y])
+            text.set_position((rank + offset, y - 0.05))
+            text.set_text(f"{round(y * 100, 1)} %")
+        png = self._cumulative_png[rank] = self._render(fig)
+        if len(self._cumulative_png) > self.max_cached:
+            self._cumulative_png.popitem(last=False)
+        return png
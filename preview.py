@@ -0,0 +1,38 @@
+import numpy as np
+from PIL import Image
+
+from processor import quality_curves
+
+
+def downscale(img, max_side=512):
+    """
+    A function to shrink an image so its longer side is at most max_side, averaging the pixels it merges.
+
+    Parameters:
+    -----------
+    - img (uint8 array): The image, either (H, W) or (H, W, C).
+    - max_side (int): Longest side of the result. Smaller images are returned as they are.
+    """
+    height, width = img.shape[:2]
+    scale = max_side / max(height, width)
+    if scale >= 1:
+        return img
+    size = (max(1, round(width * scale)), max(1, round(height * scale)))
+    return np.asarray(Image.fromarray(img).resize(size, Image.BOX))
+
+
+def map_rank(rank, source, target):
+    """
+    A function to carry a rank over to another decomposition of the same image, e.g. from a downscaled
+    preview to the full resolution, so that both keep the same share of the energy.
+
+    Parameters:
+    -----------
+    - rank (int): Rank chosen on the source decomposition.
+    - source (Factors): Decomposition the rank was chosen for.
+    - target (Factors): Decomposition the rank is mapped to.
+    """
+    kept = quality_curves(source.S, source.total_energy, np.prod(source.shape))["joint_energy"]
+    energy = kept[min(rank, kept.size - 1)]
+    reached = quality_curves(target.S, target.total_energy, np.prod(target.shape))["joint_energy"] >= energy
+    return int(np.argmax(reached)) if reached.any() else target.max_rank
@@ -1,40 +1,734 @@
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from functools import partial
+
 import numpy as np
-import streamlit as st
+
+from cache import derived_key, image_key
+from instrument import stage
+from ycbcr import CHROMA_OFFSET, YCbCrFactors, rgb_to_ycbcr, subsample
+
+
+ENGINES = ("exact", "randomized", "tiled")
+COLOR_MODES = ("rgb", "ycbcr")
+# Ranks tried, largest first, when the memory limit forces a truncated or tiled decomposition
+FALLBACK_RANKS = (400, 200, 100, 50, 25)
+TILE_BUDGETS = ("uniform", "energy")
+
+
+def randomized_svd(A, rank, oversample=10, n_iter=4, seed=0):
+    """
+    A function to compute the top singular triplets of a matrix with a randomized range finder.
+
+    Parameters:
+    -----------
+    - A (m x n array or stack of them): The matrix to decompose. Leading axes are treated as a batch.
+    - rank (int): Number of singular triplets to return.
+    - oversample (int): Extra random directions sampled to improve the captured subspace.
+    - n_iter (int): Power iterations, which sharpen the spectrum for slowly decaying singular values.
+    - seed (int): Seed for the random test matrix, so repeated runs give identical factors.
+    """
+    # float32 input stays float32, anything else is promoted to float64
+    A = np.asarray(A, dtype=np.result_type(A.dtype, np.float32))
+    m, n = A.shape[-2:]
+    At = np.swapaxes(A, -1, -2)
+    rank = min(rank, m, n)
+    sketch = min(rank + oversample, m, n)
+
+    rng = np.random.default_rng(seed)
+    Q, _ = np.linalg.qr(A @ rng.standard_normal((n, sketch), dtype=A.dtype))
+    for _ in range(n_iter):
+        # Re-orthonormalise between passes, otherwise everything collapses onto the top singular vector
+        Q, _ = np.linalg.qr(At @ Q)
+        Q, _ = np.linalg.qr(A @ Q)
+
+    U_small, S, Vt = np.linalg.svd(np.swapaxes(Q, -1, -2) @ A, full_matrices=False)
+    U = Q @ U_small
+    return U[..., :rank], S[..., :rank], Vt[..., :rank, :]
+
+
+def spectrum_accuracy(S_approx, S_exact):
+    """
+    A function to compare a truncated spectrum against the exact one.
+
+    Parameters:
+    -----------
+    - S_approx (array): Singular values from a truncated engine.
+    - S_exact (array): Singular values from the exact SVD.
+    """
+    k = S_approx.size
+    top = S_exact[:k]
+    relative = np.abs(S_approx - top) / np.maximum(top, np.finfo(top.dtype).tiny)
+    return {
+        "rank": k,
+        "max_relative_error": float(relative.max()) if k else 0.0,
+        "mean_relative_error": float(relative.mean()) if k else 0.0,
+        "captured_energy": float(np.sum(S_approx**2) / np.sum(S_exact**2)),
+        "exact_energy": float(np.sum(top**2) / np.sum(S_exact**2)),
+    }
+
+
+METRICS = ("energy", "error", "psnr")
+
+
+def quality_curves(S, total_energy, pixels, peak=255.0):
+    """
+    A function to compute the quality of every rank at once from the singular values alone.
+
+    By Eckart-Young, the squared error of the rank-k approximation is the sum of the squared singular
+    values after k, so no image has to be rebuilt. Index k of every curve is the rank-k approximation.
+
+    Parameters:
+    -----------
+    - S (C x K array): Singular values of each channel.
+    - total_energy (C array): Squared Frobenius norm of each channel, which also covers any truncated tail.
+    - pixels (int): Pixels per channel.
+    - peak (float): Largest pixel value, used for the PSNR.
+    """
+    S = np.atleast_2d(S)
+    total_energy = np.asarray(total_energy, dtype=np.float64).reshape(-1, 1)
+    kept = np.concatenate([np.zeros((S.shape[0], 1)), np.cumsum(S.astype(np.float64)**2, axis=1)], axis=1)
+    # Rounding can push the kept energy a hair past the total, which would give a negative error
+    residual = np.maximum(total_energy - kept, 0.0)
+    mse = residual / pixels
+    psnr = psnr_from_mse(mse, peak)
+    return {
+        "energy": kept / total_energy,
+        "error": np.sqrt(residual / total_energy),
+        "mse": mse,
+        "psnr": psnr,
+        "joint_energy": kept.sum(axis=0) / total_energy.sum(),
+        "joint_error": np.sqrt(residual.sum(axis=0) / total_energy.sum()),
+        "joint_psnr": psnr_from_mse(mse.mean(axis=0), peak),
+    }
+
+
+def psnr_from_mse(mse, peak=255.0):
+    with np.errstate(divide="ignore"):
+        return 10 * np.log10(peak**2 / mse)
+
+
+def _first_rank(curve, target, metric):
+    # Energy and PSNR grow with the rank, the relative error shrinks
+    reached = curve <= target if metric == "error" else curve >= target
+    return int(np.argmax(reached)) if reached.any() else curve.shape[-1] - 1
+
+
+class Spectrum:
+    def __init__(self, factors, max_points=2000) -> None:
+        """
+        Spectrum analytics of a decomposition, computed once for all channels and ranks.
+
+        Parameters:
+        -----------
+        - factors (Factors): The decomposition of the image.
+        - max_points (int): Upper bound on the points of the display curves, so long spectra plot quickly.
+        """
+        height, width = factors.shape
+        self.factors = factors
+        self.S = factors.S
+        self.curves = quality_curves(factors.S, factors.total_energy, height * width)
+        # Index k of the rank curves is the rank-k approximation, so the cumulative energy starts at 0
+        self.cumulative_energy = self.curves["energy"]
+        self.points = _display_points(self.S.shape[1], max_points)
+        self.rank_points = _display_points(self.S.shape[1] + 1, max_points)
+
+
+def _display_points(n, max_points):
+    if n <= max_points:
+        return np.arange(n)
+    return np.unique(np.linspace(0, n - 1, max_points).round().astype(int))
+
+
+def channel_stack(img):
+    """
+    A function to view an image as a (C, H, W) stack of channels. Grayscale images become a single channel.
+
+    Parameters:
+    -----------
+    - img (array): The decoded image, either (H, W) or (H, W, C).
+    """
+    if img.ndim == 2:
+        return img[np.newaxis]
+    return np.moveaxis(img, -1, 0)
+
+
+class Factors:
+    def __init__(self, U, S, Vt, total_energy=None) -> None:
+        """
+        The singular value decomposition of every channel of an image.
+
+        Parameters:
+        -----------
+        - U (C x H x K array): Left singular vectors of each channel.
+        - S (C x K array): Singular values of each channel, in descending order.
+        - Vt (C x K x W array): Right singular vectors of each channel.
+        - total_energy (C array): Squared Frobenius norm of each channel. Only needed when the factors are
+          truncated, otherwise it is the sum of the squared singular values.
+        """
+        self.U = U
+        self.S = S
+        self.Vt = Vt
+        self.total_energy = np.sum(S.astype(np.float64)**2, axis=1) if total_energy is None else total_energy
+
+    @property
+    def channels(self):
+        return self.S.shape[0]
+
+    @property
+    def shape(self):
+        return self.U.shape[1], self.Vt.shape[2]
+
+    @property
+    def max_rank(self):
+        return self.S.shape[1]
+
+    @property
+    def nbytes(self):
+        return self.U.nbytes + self.S.nbytes + self.Vt.nbytes
+
+    def __len__(self):
+        return self.channels
+
+    def __getitem__(self, channel):
+        return self.U[channel], self.S[channel], self.Vt[channel]
+
+    def reconstructor(self, dtype=np.float64):
+        return Reconstructor(self, dtype=dtype)
+
+
+def _decompose_tile(tile, dtype=np.float64, max_rank=None):
+    # Runs in a worker process, so tiles travel as uint8 and are only promoted to float there. np.linalg.svd
+    # always works in double precision, so only the returned factors are in `dtype`.
+    stack = channel_stack(tile).astype(np.float64)
+    U, S, Vt = np.linalg.svd(stack, full_matrices=False)
+    if max_rank is None or max_rank >= S.shape[1]:
+        return Factors(U.astype(dtype, copy=False), S.astype(dtype, copy=False), Vt.astype(dtype, copy=False))
+    # Copies, so the full-rank factors are freed instead of travelling back to the parent process
+    return Factors(U[:, :, :max_rank].astype(dtype), S[:, :max_rank].astype(dtype), Vt[:, :max_rank].astype(dtype),
+                   np.einsum("chw,chw->c", stack, stack))
+
+
+class TiledFactors:
+    def __init__(self, shape, channels, tiles) -> None:
+        """
+        Independent singular value decompositions of fixed-size blocks of an image.
+
+        Parameters:
+        -----------
+        - shape (tuple): Height and width of the whole image.
+        - channels (int): Number of channels of the image.
+        - tiles (list): (rows, cols, Factors) for every block, where rows and cols are slices into the image.
+        """
+        self._shape = shape
+        self._channels = channels
+        self.tiles = tiles
+        # Root-sum-square of the tile spectra: its cumulative energy at j is exactly the energy kept
+        # when every tile uses j singular values, so the usual spectrum plots stay meaningful
+        S = np.zeros((channels, max(f.max_rank for _, _, f in tiles)))
+        for _, _, f in tiles:
+            S[:, :f.max_rank] += f.S**2
+        self.S = np.sqrt(S)
+        self.total_energy = sum(f.total_energy for _, _, f in tiles)
+
+    @property
+    def channels(self):
+        return self._channels
+
+    @property
+    def shape(self):
+        return self._shape
+
+    @property
+    def max_rank(self):
+        return self.S.shape[1]
+
+    @property
+    def nbytes(self):
+        return sum(f.nbytes for _, _, f in self.tiles)
+
+    def tile_ranks(self, rank, budget="uniform"):
+        """
+        A function to split a rank into per-tile ranks.
+
+        Parameters:
+        -----------
+        - rank (int): Rank requested for the whole image.
+        - budget (str): "uniform" gives every tile the same rank. "energy" spends the same total number of
+          terms on the tiles with the largest singular values, so busy tiles get more than flat ones.
+        """
+        if budget not in TILE_BUDGETS:
+            raise ValueError(f"Unknown tile budget {budget!r}, expected one of {TILE_BUDGETS}")
+        ranks = [min(rank, f.max_rank) for _, _, f in self.tiles]
+        if budget == "uniform" or not sum(ranks):
+            return ranks
+        energies = [np.sum(f.S**2, axis=0) for _, _, f in self.tiles]
+        threshold = np.sort(np.concatenate(energies))[::-1][sum(ranks) - 1]
+        return [int(np.count_nonzero(e >= threshold)) for e in energies]
+
+    def reconstructor(self, dtype=np.float64, budget="uniform"):
+        return TiledReconstructor(self, dtype=dtype, budget=budget)
+
+
+class Reconstructor:
+    def __init__(self, factors, dtype=np.float64, rebuild_ratio=0.5, drift_tolerance=0.25) -> None:
+        """
+        Rebuilds low rank images from a set of factors into buffers that are allocated once and reused.
+
+        The last approximation is kept, so moving from rank k to k + d only adds (or removes) the d rank-one
+        terms in between instead of rebuilding the whole image.
+
+        Parameters:
+        -----------
+        - factors (Factors): The decomposition to reconstruct from.
+        - dtype (type): Working precision. np.float32 halves the memory and roughly doubles the matmul speed.
+        - rebuild_ratio (float): Rebuild from scratch when the rank changes by more than this fraction of the new rank.
+        - drift_tolerance (float): Bound on accumulated rounding error, in grey levels, before forcing a rebuild.
+        """
+        self.factors = factors
+        self.dtype = np.dtype(dtype)
+        self.rebuild_ratio = rebuild_ratio
+        self.drift_tolerance = drift_tolerance
+        # Cast once up front, so every reconstruction reads the factors in the working precision
+        self.U = factors.U.astype(self.dtype, copy=False)
+        self.S = factors.S.astype(self.dtype, copy=False)
+        self.Vt = factors.Vt.astype(self.dtype, copy=False)
+
+        height, width = factors.shape
+        self._scaled = np.empty(height * factors.max_rank, dtype=self.dtype)
+        self._work = np.empty((height, width), dtype=self.dtype)
+        self._approx = np.zeros((factors.channels, height, width), dtype=self.dtype)
+        self.current_rank = 0
+        self.drift = 0.0
+        shape = (height, width) if factors.channels == 1 else (height, width, factors.channels)
+        self.out = np.empty(shape, dtype=np.uint8)
+
+    def _terms(self, c, start, stop):
+        # U_k diag(S_k) is just U_k with its columns scaled, no k x k diagonal matrix needed
+        height = self.factors.shape[0]
+        scaled = self._scaled[:height * (stop - start)].reshape(height, stop - start)
+        np.multiply(self.U[c, :, start:stop], self.S[c, start:stop], out=scaled)
+        return scaled, self.Vt[c, start:stop]
+
+    def _rebuild(self, rank):
+        for c in range(self.factors.channels):
+            scaled, Vt = self._terms(c, 0, rank)
+            np.matmul(scaled, Vt, out=self._approx[c])
+        self.drift = 0.0
+
+    def _update(self, rank):
+        start, stop = sorted((self.current_rank, rank))
+        for c in range(self.factors.channels):
+            scaled, Vt = self._terms(c, start, stop)
+            np.matmul(scaled, Vt, out=self._work)
+            if rank > self.current_rank:
+                self._approx[c] += self._work
+            else:
+                self._approx[c] -= self._work
+        # Every added or removed term can leave up to eps * sigma of rounding error behind
+        self.drift += float(np.finfo(self.dtype).eps * self.S[:, start:stop].sum(axis=1).max())
+
+    def approximate(self, rank):
+        """
+        A function to update the unclipped rank-k approximation, returned as a (C, H, W) array in the working
+        precision. The array is reused by the next call.
+
+        Parameters:
+        -----------
+        - rank (int): Number of singular values used.
+        """
+        delta = abs(rank - self.current_rank)
+        if delta > self.rebuild_ratio * rank or self.drift > self.drift_tolerance:
+            self._rebuild(rank)
+        elif delta:
+            self._update(rank)
+        self.current_rank = rank
+        return self._approx
+
+    def reconstruct(self, rank, out=None):
+        """
+        A function to write the rank-k approximation of every channel as a clipped and rounded uint8 image.
+
+        Parameters:
+        -----------
+        - rank (int): Number of singular values used.
+        - out (uint8 array): Optional destination, by default an internal buffer that is overwritten on the next call.
+        """
+        approx = self.approximate(rank)
+        out = self.out if out is None else out
+        channels = out if out.ndim == 3 else out[:, :, np.newaxis]
+        for c in range(self.factors.channels):
+            np.clip(approx[c], 0, 255, out=self._work)
+            np.rint(self._work, out=self._work)
+            np.copyto(channels[:, :, c], self._work, casting="unsafe")
+        return out
+
+
+class TiledReconstructor:
+    def __init__(self, factors, dtype=np.float64, budget="uniform") -> None:
+        """
+        Rebuilds a tiled decomposition with one incremental Reconstructor per tile.
+
+        Parameters:
+        -----------
+        - factors (TiledFactors): The tiled decomposition to reconstruct from.
+        - dtype (type): Working precision.
+        - budget (str): How the rank is split across tiles, see TiledFactors.tile_ranks.
+        """
+        self.factors = factors
+        self.dtype = np.dtype(dtype)
+        self.budget = budget
+        self.tiles = [(rows, cols, Reconstructor(f, dtype=dtype)) for rows, cols, f in factors.tiles]
+        height, width = factors.shape
+        shape = (height, width) if factors.channels == 1 else (height, width, factors.channels)
+        self.out = np.empty(shape, dtype=np.uint8)
+        self._approx = None
+
+    def approximate(self, rank):
+        # Only allocated when asked for, the uint8 path writes the tiles straight into the output
+        if self._approx is None:
+            self._approx = np.empty((self.factors.channels, *self.factors.shape), dtype=self.dtype)
+        for (rows, cols, reconstructor), k in zip(self.tiles, self.factors.tile_ranks(rank, self.budget)):
+            self._approx[:, rows, cols] = reconstructor.approximate(k)
+        return self._approx
+
+    def reconstruct(self, rank, out=None):
+        out = self.out if out is None else out
+        for (rows, cols, reconstructor), k in zip(self.tiles, self.factors.tile_ranks(rank, self.budget)):
+            reconstructor.reconstruct(k, out=out[rows, cols])
+        return out
+
+
+def progressive_ranks(rank, first=1):
+    """
+    A function to list the ranks of a progressive preview: first, 2 * first, 4 * first, ... and finally rank.
+
+    Parameters:
+    -----------
+    - rank (int): Rank of the final approximation.
+    - first (int): Rank of the first, coarsest preview.
+    """
+    ranks = []
+    step = max(first, 1)
+    while step < rank:
+        ranks.append(step)
+        step *= 2
+    return ranks + [rank]
+
+
+def progressive(reconstructor, rank, ranks=None):
+    """
+    A generator of successively finer approximations, yielding (rank, image) up to the requested rank.
+
+    Each approximation adds the terms between the previous rank and the new one to the last image, so the whole
+    sequence costs about as much as building the final image once. The yielded image is the reconstructor's
+    buffer and is overwritten by the next step, copy it to keep it.
+
+    Parameters:
+    -----------
+    - reconstructor (Reconstructor): Any reconstructor, e.g. from Factors.reconstructor().
+    - rank (int): Rank of the final approximation.
+    - ranks (list): Increasing ranks to yield, progressive_ranks(rank) by default.
+    """
+    for k in progressive_ranks(rank) if ranks is None else ranks:
+        yield k, reconstructor.reconstruct(k)
+
+
+def estimate_peak_bytes(shape, engine="exact", dtype=np.float64, max_rank=None, tile_size=512, workers=None,
+                        oversample=10):
+    """
+    A function to estimate the peak memory of decomposing and reconstructing an image, before doing it.
+
+    The estimate covers the float copy of the image, the factors, the LAPACK work arrays of the SVDs running at
+    the same time and the reconstruction buffers. It is deliberately on the high side.
+
+    Parameters:
+    -----------
+    - shape (tuple): Shape of the uint8 image, (H, W) or (H, W, C).
+    - engine (str): "exact", "randomized" or "tiled".
+    - dtype (type): Precision of the factors and the reconstruction, and of the randomized sketch.
+    - max_rank (int): Factors kept by the randomized engine, or per tile by the tiled engine.
+    - tile_size (int): Block size of the tiled engine.
+    - workers (int): Parallel SVDs (threads over channels, or processes over tiles).
+    - oversample (int): Extra directions of the randomized range finder.
+    """
+    height, width = shape[:2]
+    channels = 1 if len(shape) == 2 else shape[2]
+    pixels = channels * height * width
+    size = np.dtype(dtype).itemsize
+    workers = max(1, workers or 1)
+    # Image, reconstruction accumulator, one work plane, the uint8 output and OpenBLAS' thread buffers
+    common = pixels + pixels * size + height * width * size + pixels + 64 * 2**20
+
+    if engine == "randomized":
+        k = min(max_rank + oversample, height, width)
+        factors = channels * (height + width + 1) * k * size
+        # Float copy of the image, plus the sketch, its transpose product and the projected matrix
+        work = pixels * size + 3 * channels * (height + width) * k * size
+    elif engine == "tiled":
+        t = min(tile_size, height, width)
+        k = min(t, max_rank or t)
+        tiles = -(-height // t) * -(-width // t)
+        factors = channels * tiles * (2 * t + 1) * k * size
+        # Every worker holds a double tile, LAPACK's copies and the full-rank double tile factors, while the
+        # truncated results of finished tiles are pickled back to this process
+        work = min(workers, tiles) * channels * 7 * t * t * 8 + factors
+    else:
+        k = min(height, width)
+        factors = channels * (height + width + 1) * k * size
+        concurrent = min(workers, channels)
+        # np.linalg.svd only has a double precision driver, so the image copy and gesdd's copy of the matrix
+        # and k x k work arrays are doubles whatever the dtype. Other dtypes add the double factors of every
+        # channel in flight before they are cast into the smaller ones.
+        work = pixels * 8 + concurrent * (height * width + 2 * (height + width) * k + 4 * k * k) * 8
+        if size != 8:
+            work += concurrent * (height + width + 1) * k * 8
+    return int(common + factors + work)
 
 
 class Decompose:
-    def __init__(self, img) -> None:
+    def __init__(self, img, cache=None, engine="exact", max_rank=None, workers=None, tile_size=512, profiler=None,
+                 color_mode="rgb", chroma_subsampling=2, dtype=np.float64, memory_limit=None, content_key=None) -> None:
+        """
+        Parameters:
+        -----------
+        - img (array): The decoded image, either (H, W) or (H, W, C).
+        - cache (FactorCache): Optional cache so factors survive across reruns.
+        - engine (str): "exact" for the full thin SVD, "randomized" for a truncated one, or "tiled" for
+          independent SVDs of tile_size x tile_size blocks.
+        - max_rank (int): Number of factors kept by the randomized engine. The tiled engine keeps this many per
+          tile when given.
+        - workers (int): Decompose channels on a thread pool of this size instead of one batched call.
+          The tiled engine uses a process pool of this size instead.
+        - tile_size (int): Block size of the tiled engine.
+        - profiler (Profiler): Optional profiler recording the time and memory of each decomposition stage.
+        - color_mode (str): "rgb" decomposes the color channels as they are. "ycbcr" decomposes luma at full
+          resolution and the two chroma channels at reduced resolution, see YCbCrFactors.
+        - chroma_subsampling (int): Chroma subsampling factor along both axes in "ycbcr" mode.
+        - dtype (type): Precision of the factors. np.float32 halves their memory and that of the reconstruction.
+          The exact and tiled SVDs still run in double precision, which is all np.linalg.svd offers, and
+          are cast channel by channel. The randomized engine also forms its sketch in this precision.
+        - memory_limit (int): Bytes the decomposition may use at peak, see estimate_peak_bytes. When the chosen
+          engine would exceed it, a randomized and then a tiled decomposition with fewer factors is used instead,
+          and `fallback` says so. MemoryError is raised when nothing fits.
+        - content_key (str): Key identifying the pixels of `img`, e.g. a hash of the uploaded file computed once.
+          Cache keys are then derived from it instead of hashing the whole image on every lookup.
+        """
+        if engine not in ENGINES:
+            raise ValueError(f"Unknown SVD engine {engine!r}, expected one of {ENGINES}")
+        if color_mode not in COLOR_MODES:
+            raise ValueError(f"Unknown color mode {color_mode!r}, expected one of {COLOR_MODES}")
+        if engine == "randomized" and not max_rank:
+            raise ValueError("The randomized engine needs a max_rank")
         self.dimensions = len(img.shape)
         self.rank = 0
+        self.cache = cache
+        self.engine = engine
+        self.max_rank = max_rank
+        self.workers = workers
+        self.tile_size = tile_size
+        self.profiler = profiler
+        self.color_mode = color_mode
+        self.chroma_subsampling = chroma_subsampling
+        self.dtype = np.dtype(dtype)
+        self.memory_limit = memory_limit
+        self.content_key = content_key
+        self.fallback = None
+        if memory_limit is not None:
+            self._fit_memory(img.shape)
+
+    def estimate_peak_bytes(self, shape, engine=None, max_rank=None):
+        """
+        A function to estimate the peak memory of this decomposition, see the module-level estimate_peak_bytes.
+
+        Parameters:
+        -----------
+        - shape (tuple): Shape of the image.
+        - engine (str): Engine to estimate, the configured one by default.
+        - max_rank (int): Factors kept, the configured number by default.
+        """
+        engine = engine or self.engine
+        return estimate_peak_bytes(shape, engine, self.dtype, max_rank or self.max_rank, self.tile_size, self.workers)
+
+    def _fit_memory(self, shape):
+        if self.estimate_peak_bytes(shape) <= self.memory_limit:
+            return
+        largest = min(self.max_rank or FALLBACK_RANKS[0], *shape[:2])
+        ranks = [largest] + [r for r in FALLBACK_RANKS if r < largest]
+        for engine in ("randomized", "tiled"):
+            for rank in ranks:
+                peak = self.estimate_peak_bytes(shape, engine, rank)
+                if peak <= self.memory_limit:
+                    self.fallback = (f"The {self.engine} SVD would need about {self.estimate_peak_bytes(shape) / 2**20:.0f} MB, "
+                                     f"using the {engine} engine with rank {rank} instead ({peak / 2**20:.0f} MB)")
+                    self.engine, self.max_rank = engine, rank
+                    return
+        raise MemoryError(f"An image of shape {shape} does not fit in {self.memory_limit / 2**20:.0f} MB")
+
+    def _svd(self, stack):
+        if self.engine == "randomized":
+            return randomized_svd(stack, self.max_rank)
+        return np.linalg.svd(stack, full_matrices=False)
+
+    def _decompose_tiled(self, img):
+        height, width = img.shape[:2]
+        boxes = [(slice(y, min(y + self.tile_size, height)), slice(x, min(x + self.tile_size, width)))
+                 for y in range(0, height, self.tile_size) for x in range(0, width, self.tile_size)]
+        tiles = (img[rows, cols] for rows, cols in boxes)
+        decompose_tile = partial(_decompose_tile, dtype=self.dtype, max_rank=self.max_rank)
+        if self.workers and self.workers > 1 and len(boxes) > 1:
+            with ProcessPoolExecutor(max_workers=self.workers) as pool:
+                parts = list(pool.map(decompose_tile, tiles, chunksize=max(1, len(boxes) // (4 * self.workers))))
+        else:
+            parts = list(map(decompose_tile, tiles))
+        channels = 1 if img.ndim == 2 else img.shape[2]
+        return TiledFactors((height, width), channels, [(rows, cols, f) for (rows, cols), f in zip(boxes, parts)])
+
+    def _decompose_ycbcr(self, img):
+        with stage(self.profiler, "to_ycbcr"):
+            ycc = rgb_to_ycbcr(img, dtype=self.dtype)
+            # Centered on neutral grey, so rank 0 (and every dropped term) leaves the color neutral
+            chroma = subsample(ycc[:, :, 1:], self.chroma_subsampling) - CHROMA_OFFSET[1:].astype(self.dtype)
+        luma = self._decompose(ycc[:, :, 0])
+        return YCbCrFactors(luma, self._decompose(chroma), self.chroma_subsampling, img.shape[:2])
+
+    def _decompose(self, img):
+        if self.engine == "tiled":
+            with stage(self.profiler, "svd", engine=self.engine):
+                return self._decompose_tiled(img)
+        # np.linalg.svd promotes anything to double, so the exact engine gets doubles directly instead of a
+        # single precision copy that is copied up again
+        svd_dtype = self.dtype if self.engine == "randomized" else np.dtype(np.float64)
+        with stage(self.profiler, "to_float"):
+            # channel_stack is a view, so this is the only copy of the pixels
+            stack = channel_stack(img).astype(svd_dtype)
+        with stage(self.profiler, "svd", engine=self.engine):
+            threaded = self.workers and self.workers > 1 and stack.shape[0] > 1
+            if threaded or svd_dtype != self.dtype:
+                # LAPACK releases the GIL, so channels decompose in parallel on separate threads. Each result is
+                # written into preallocated factors, so they never exist twice as with np.stack, and only one
+                # channel at a time exists in double precision before the cast.
+                channels, height, width = stack.shape
+                k = min(height, width) if self.engine == "exact" else min(self.max_rank, height, width)
+                U = np.empty((channels, height, k), dtype=self.dtype)
+                S = np.empty((channels, k), dtype=self.dtype)
+                Vt = np.empty((channels, k, width), dtype=self.dtype)
+
+                def decompose_channel(c):
+                    U[c], S[c], Vt[c] = self._svd(stack[c])
 
-    def svd_color_img(self, img):
-        # Split the image into its RBG channels
-        red_channel = img[:, :, 0]
-        green_channel = img[:, :, 1]
-        blue_channel = img[:, :, 2]
-
-        # Singular Value Decomposition for each channel seperately
-        U_red, S_red, Vt_red = np.linalg.svd(red_channel, full_matrices=False)
-        U_green, S_green, Vt_green = np.linalg.svd(green_channel, full_matrices=False)
-        U_blue, S_blue, Vt_blue = np.linalg.svd(blue_channel, full_matrices=False)
-
-        max_S_red, max_S_green, max_S_blue = S_red.size, S_green.size, S_blue.size
-        num_S = min(max_S_red, max_S_green, max_S_blue)
-        self.rank = st.slider(
-            "**SLIDE TO ADJUST THE RANK**",
-            min_value=0, max_value=num_S - 1,
-            help="Higher the rank, closer the compressed image is to the original image.")    
-        return ((U_red, S_red, Vt_red), (U_green, S_green, Vt_green), (U_blue, S_blue, Vt_blue))
-    
-    def svd_grayscale_img(self, img):
-        # Singular Value Decomposition
-        U, S, Vt = np.linalg.svd(img, full_matrices=False)
-        num_S = S.size
-        self.rank = st.slider(
-            "**SLIDE TO ADJUST THE RANK**",
-            min_value=0, max_value=num_S - 1,
-            help="Higher the rank, closer the compressed image is to the original image.")
-        return U, S, Vt
+                if threaded:
+                    with ThreadPoolExecutor(max_workers=self.workers) as pool:
+                        list(pool.map(decompose_channel, range(channels)))
+                else:
+                    for c in range(channels):
+                        decompose_channel(c)
+            else:
+                U, S, Vt = self._svd(stack)
+            total_energy = np.einsum("chw,chw->c", stack, stack, dtype=np.float64) if self.engine == "randomized" else None
+        return Factors(U, S, Vt, total_energy)
+
+    def decompose(self, img):
+        """
+        A function to compute the singular value decomposition of every channel of the image at once.
+
+        Parameters:
+        -----------
+        - img (array): The decoded image, either (H, W) or (H, W, C).
+        """
+        ycbcr = self.color_mode == "ycbcr" and img.ndim == 3
+        compute = self._decompose_ycbcr if ycbcr else self._decompose
+        # Factors only depend on the pixels, so a rerun with the same image can skip the SVD entirely
+        if self.cache is None:
+            return compute(img)
+        with stage(self.profiler, "cache_lookup"):
+            key = self.cache_key(img)
+            factors = self.cache.get(key)
+        if factors is None:
+            factors = self.cache.put(key, compute(img))
+        return factors
+
+    def cache_key(self, img):
+        """
+        A function to compute the key of the image's factors in the cache, which covers every setting that
+        changes the decomposition.
+
+        Parameters:
+        -----------
+        - img (array): The decoded image.
+        """
+        ycbcr = self.color_mode == "ycbcr" and img.ndim == 3
+        settings = (self.engine, self.max_rank, self.tile_size if self.engine == "tiled" else None,
+                    self.chroma_subsampling if ycbcr else None, self.dtype.str)
+        if self.content_key is not None:
+            return derived_key(self.content_key, *settings)
+        return image_key(img, *settings)
+
+    def cached(self, img):
+        """
+        A function to return the cached factors of the image without computing them, or None.
+
+        Parameters:
+        -----------
+        - img (array): The decoded image.
+        """
+        if self.cache is None:
+            return None
+        with stage(self.profiler, "cache_lookup"):
+            return self.cache.get(self.cache_key(img))
+
+    def accuracy_report(self, img, factors):
+        """
+        A function to measure how closely the selected engine reproduces the exact spectrum of each channel.
+
+        Parameters:
+        -----------
+        - img (array): The image that was decomposed.
+        - factors (Factors): The decomposition returned by the engine.
+        """
+        exact = np.linalg.svd(channel_stack(img).astype(np.float64), compute_uv=False)
+        return [spectrum_accuracy(S, S_exact) for S, S_exact in zip(factors.S, exact)]
+
+    def quality_curves(self, factors):
+        """
+        A function to compute energy, relative error and PSNR for every rank of a decomposition, per channel and jointly.
+
+        Parameters:
+        -----------
+        - factors (Factors): The decomposition of the image.
+        """
+        return Spectrum(factors).curves
+
+    def select_rank(self, factors, target, metric="psnr", joint=True, spectrum=None):
+        """
+        A function to find the smallest rank meeting a quality target, without any trial reconstruction.
+
+        If the stored factors cannot reach the target, the largest available rank is returned.
+
+        Parameters:
+        -----------
+        - factors (Factors): The decomposition of the image.
+        - target (float): Energy fraction kept, relative Frobenius error, or PSNR in dB.
+        - metric (str): "energy", "error" or "psnr".
+        - joint (bool): Measure all channels together and return one rank, or return one rank per channel.
+        - spectrum (Spectrum): Spectrum analytics already computed for these factors, to reuse their curves.
+        """
+        if metric not in METRICS:
+            raise ValueError(f"Unknown quality metric {metric!r}, expected one of {METRICS}")
+        curves = spectrum.curves if spectrum is not None else self.quality_curves(factors)
+        if joint:
+            return _first_rank(curves["joint_" + metric], target, metric)
+        return np.array([_first_rank(curve, target, metric) for curve in curves[metric]])
+
+    def progressive_approx(self, factors, dtype=np.float64):
+        """
+        A generator of (rank, image) approximations at ranks 1, 2, 4, ... up to self.rank, see `progressive`.
+
+        Parameters:
+        -----------
+        - factors (Factors): The decomposition of the image.
+        - dtype (type): Working precision of the reconstruction.
+        """
+        return progressive(factors.reconstructor(dtype=dtype), self.rank)
 
     def low_rank_approx(self, U, S, Vt):
         """
@@ -47,8 +741,5 @@ class Decompose:
         - S (m x n array): Is a diagonal matrix containing the singular values of A.
         - Vt (n x n array): Right Singular Vectors which are the rows of the matrix Vt.
         """
-        S = np.diag(S)
-        X_approx = U[:, :self.rank] @ S[:self.rank, :self.rank] @ Vt[:self.rank, :]
+        X_approx = (U[:, :self.rank] * S[:self.rank]) @ Vt[:self.rank, :]
         return X_approx
-    
-    
\ No newline at end of file
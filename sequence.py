@@ -0,0 +1,115 @@
+import numpy as np
+
+from processor import Factors, channel_stack, randomized_svd
+
+
+def subspace_svd(A, basis, rank, n_iter=1):
+    """
+    A function to compute the top singular triplets of a matrix by subspace iteration from a given start.
+
+    With a start close to the wanted right singular subspace, e.g. the one of the previous video frame, a single
+    iteration is usually enough, where a random start needs several.
+
+    Parameters:
+    -----------
+    - A (m x n array or stack of them): The matrix to decompose. Leading axes are treated as a batch.
+    - basis (n x s array or stack of them): Starting right subspace, with s >= rank columns.
+    - rank (int): Number of singular triplets to return.
+    - n_iter (int): Subspace iterations, each one multiplies by A^T and A once more.
+    """
+    At = np.swapaxes(A, -1, -2)
+    Q, _ = np.linalg.qr(A @ basis)
+    for _ in range(n_iter - 1):
+        Q, _ = np.linalg.qr(At @ Q)
+        Q, _ = np.linalg.qr(A @ Q)
+    U_small, S, Vt = np.linalg.svd(np.swapaxes(Q, -1, -2) @ A, full_matrices=False)
+    return (Q @ U_small)[..., :rank], S[..., :rank], Vt[..., :rank, :], Vt
+
+
+class SequenceDecomposer:
+    def __init__(self, rank, oversample=10, n_iter=2, tolerance=0.1, cut_threshold=0.25, cold_engine="exact") -> None:
+        """
+        Decomposes the frames of a sequence, starting every frame from the subspace of the previous one.
+
+        A frame is solved cold again when it differs too much from the previous frame, e.g. after a cut, or when
+        its warm-started residual (the share of the energy not captured by `rank` factors) exceeds the residual
+        of the previous frame by more than `tolerance`, i.e. the carried subspace no longer fits.
+
+        Parameters:
+        -----------
+        - rank (int): Number of factors kept per channel.
+        - oversample (int): Extra directions carried from frame to frame, which absorb motion between frames.
+        - n_iter (int): Subspace iterations per warm frame.
+        - tolerance (float): Relative increase of the residual over the previous frame that is still accepted.
+        - cut_threshold (float): Share of the frame's energy in its difference to the previous frame above which
+          the frame is treated as a scene cut and solved cold without trying the warm start.
+        - cold_engine (str): "exact" or "randomized", used for the first frame and whenever the scene changes.
+        """
+        if cold_engine not in ("exact", "randomized"):
+            raise ValueError(f"Unknown cold engine {cold_engine!r}, expected one of ('exact', 'randomized')")
+        self.rank = rank
+        self.oversample = oversample
+        self.n_iter = n_iter
+        self.tolerance = tolerance
+        self.cut_threshold = cut_threshold
+        self.cold_engine = cold_engine
+        self.basis = None
+        self.reference_residual = None
+        self.previous = None
+        self.warm_frames = 0
+        self.cold_frames = 0
+        self.last_residual = None
+
+    def reset(self):
+        self.basis = None
+        self.reference_residual = None
+        self.previous = None
+
+    def _cold(self, stack):
+        sketch = min(self.rank + self.oversample, *stack.shape[-2:])
+        if self.cold_engine == "randomized":
+            U, S, Vt = randomized_svd(stack, sketch, oversample=self.oversample)
+        else:
+            U, S, Vt = np.linalg.svd(stack, full_matrices=False)
+        return U[..., :self.rank], S[..., :self.rank], Vt[..., :self.rank, :], Vt[..., :sketch, :]
+
+    @staticmethod
+    def _residual(S, total_energy):
+        # Unexplained share of the energy of all channels together, by Eckart-Young
+        return max(0.0, 1.0 - float((S.astype(np.float64)**2).sum() / max(total_energy.sum(), np.finfo(np.float64).tiny)))
+
+    @staticmethod
+    def _residual_of_difference(stack, previous, total_energy):
+        # Share of the frame's energy that changed since the previous frame
+        difference = stack - previous
+        return float(np.einsum("chw,chw->", difference, difference) / max(total_energy.sum(), np.finfo(np.float64).tiny))
+
+    def decompose(self, frame):
+        """
+        A function to decompose the next frame of the sequence.
+
+        Parameters:
+        -----------
+        - frame (array): The frame, either (H, W) or (H, W, C). All frames must have the same shape.
+        """
+        stack = channel_stack(frame).astype(np.float64)
+        total_energy = np.einsum("chw,chw->c", stack, stack)
+        if self.previous is not None and self.previous.shape != stack.shape:
+            self.reset()
+        previous, self.previous = self.previous, stack
+
+        # The residual of the last frame belongs to the old scene, so a cut to content that is as easy to
+        # compress would pass the residual check. The frame difference catches it before the warm solve.
+        if previous is not None and self._residual_of_difference(stack, previous, total_energy) <= self.cut_threshold:
+            U, S, Vt, basis = subspace_svd(stack, np.swapaxes(self.basis, -1, -2), self.rank, self.n_iter)
+            residual = self._residual(S, total_energy)
+            if residual <= self.reference_residual * (1 + self.tolerance) + 1e-9:
+                self.warm_frames += 1
+                self.basis = basis
+                self.reference_residual = self.last_residual = residual
+                return Factors(U, S, Vt, total_energy)
+
+        U, S, Vt, self.basis = self._cold(stack)
+        self.reference_residual = self.last_residual = self._residual(S, total_energy)
+        self.cold_frames += 1
+        return Factors(U, S, Vt, total_energy)
@@ -0,0 +1,357 @@
+"""
+Headless HTTP compression service on top of the processor.py engine, for local use and load tests.
+
+    python service.py --port 8000 --workers 4 --max-queue 16
+
+    curl --data-binary @images/lenna.jpg "http://localhost:8000/compress?rank=50&format=webp" -o lenna.webp
+    curl --data-binary @photo.png "http://localhost:8000/compress?psnr=35" -o photo.jpg
+    curl http://localhost:8000/metrics
+
+Requests beyond the queue size are rejected with 503 right away instead of piling up, and requests that take
+longer than the timeout get a 504.
+"""
+import argparse
+import io
+import json
+import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, TimeoutError
+from concurrent.futures.process import BrokenProcessPool
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import numpy as np
+
+from batch import FORMATS, compress_image, decode_image
+from codec import FORMATS as IMAGE_FORMATS
+from processor import COLOR_MODES, ENGINES, TILE_BUDGETS
+
+
+def compress_request(data, options):
+    """
+    A function to compress one encoded image into (data, rank, timings). Runs inside a worker process.
+
+    Parameters:
+    -----------
+    - data (bytes): The uploaded image file.
+    - options (dict): See batch.compress_image.
+    """
+    timings = {}
+    start = time.perf_counter()
+    img = decode_image(io.BytesIO(data))
+    timings["decode"] = time.perf_counter() - start
+    output, rank = compress_image(img, options, timings)
+    return output, rank, timings
+
+
+class Metrics:
+    def __init__(self, window=60.0, max_samples=10000) -> None:
+        """
+        Thread-safe request counters and a sliding window of latencies.
+
+        Parameters:
+        -----------
+        - window (float): Seconds of completed requests used for the throughput.
+        - max_samples (int): Latest latencies kept for the percentiles.
+        """
+        self.window = window
+        self._lock = threading.Lock()
+        self._started = time.monotonic()
+        self._latencies = deque(maxlen=max_samples)
+        self.counters = dict.fromkeys(("accepted", "completed", "failed", "rejected", "timed_out", "bad_request",
+                                       "pool_restarts"), 0)
+        self.in_flight = 0
+
+    def count(self, name):
+        with self._lock:
+            self.counters[name] += 1
+
+    def enter(self):
+        with self._lock:
+            self.counters["accepted"] += 1
+            self.in_flight += 1
+
+    def leave(self):
+        with self._lock:
+            self.in_flight -= 1
+
+    def record(self, seconds):
+        with self._lock:
+            self.counters["completed"] += 1
+            self._latencies.append((time.monotonic(), seconds))
+
+    def snapshot(self, workers, max_queue):
+        with self._lock:
+            now = time.monotonic()
+            latencies = np.array([seconds for _, seconds in self._latencies])
+            recent = sum(1 for finished, _ in self._latencies if now - finished <= self.window)
+            uptime = now - self._started
+            in_flight = self.in_flight
+            counters = dict(self.counters)
+        percentiles = np.percentile(latencies, [50, 90, 99]) * 1000 if latencies.size else [None] * 3
+        return {
+            "uptime_s": uptime,
+            "workers": workers,
+            "max_queue": max_queue,
+            "in_flight": in_flight,
+            # Tasks beyond the number of workers are waiting in the pool's queue
+            "queue_depth": max(0, in_flight - workers),
+            **counters,
+            "latency_ms": dict(zip(("p50", "p90", "p99"), percentiles)),
+            "throughput_per_s": recent / min(self.window, max(uptime, 1e-9)),
+        }
+
+
+class CompressionService:
+    def __init__(self, defaults, workers=None, max_queue=None, timeout=30.0, max_body=32 * 2**20) -> None:
+        """
+        The process pool and admission control behind the HTTP handler.
+
+        Parameters:
+        -----------
+        - defaults (dict): Compression options used when a request does not override them, see batch.compress_image.
+        - workers (int): Worker processes.
+        - max_queue (int): Requests accepted at once, running or waiting. Further requests are rejected.
+        - timeout (float): Seconds a request may take, from arrival to the compressed result.
+        - max_body (int): Largest accepted upload in bytes.
+        """
+        self.defaults = defaults
+        self.workers = workers or os.cpu_count()
+        self.max_queue = max_queue or 4 * self.workers
+        self.timeout = timeout
+        self.max_body = max_body
+        self.metrics = Metrics()
+        self._slots = threading.BoundedSemaphore(self.max_queue)
+        self._pool = ProcessPoolExecutor(max_workers=self.workers)
+        self._pool_lock = threading.Lock()
+
+    def options(self, query):
+        """
+        A function to build the compression options of one request from its query string.
+
+        Parameters:
+        -----------
+        - query (str): e.g. "rank=50&format=webp" or "psnr=35&quality=80".
+        """
+        params = {name: values[-1] for name, values in parse_qs(query).items()}
+        unknown = set(params) - {"rank", "energy", "psnr", "format", "quality"}
+        if unknown:
+            raise ValueError(f"Unknown parameters {sorted(unknown)}")
+        if len({"rank", "energy", "psnr"} & set(params)) > 1:
+            raise ValueError("Give at most one of rank, energy and psnr")
+        options = dict(self.defaults)
+        if {"energy", "psnr"} & set(params):
+            options["rank"] = None
+        for name, convert in (("rank", int), ("energy", float), ("psnr", float), ("quality", int)):
+            if name in params:
+                options[name] = convert(params[name])
+        if "rank" in params and options["rank"] < 0:
+            raise ValueError("rank must not be negative")
+        if "energy" in params and not 0 < options["energy"] <= 1:
+            raise ValueError("energy must be in (0, 1]")
+        if "psnr" in params and not options["psnr"] > 0:
+            raise ValueError("psnr must be positive")
+        options["format"] = params.get("format", options["format"])
+        if options["format"] not in FORMATS:
+            raise ValueError(f"Unknown format {options['format']!r}, expected one of {tuple(FORMATS)}")
+        if options["format"] == "svdz" and (options["engine"] == "tiled" or options["color_mode"] == "ycbcr"):
+            raise ValueError("svdz output needs the exact or randomized engine in rgb color mode")
+        if not 1 <= options["quality"] <= 100:
+            raise ValueError("quality must be between 1 and 100")
+        return options
+
+    def submit(self, data, options):
+        """
+        A function to queue one compression, returning its future, or None when the service is full.
+
+        Parameters:
+        -----------
+        - data (bytes): The uploaded image file.
+        - options (dict): Compression options of the request.
+        """
+        if not self._slots.acquire(blocking=False):
+            self.metrics.count("rejected")
+            return None
+        self.metrics.enter()
+        try:
+            future = self._submit(data, options)
+        except BaseException:
+            self._release(None)
+            raise
+        # The slot is only freed once the worker is done, so timed out requests still count against the queue
+        future.add_done_callback(self._release)
+        return future
+
+    def _submit(self, data, options):
+        with self._pool_lock:
+            pool = self._pool
+            try:
+                return pool.submit(compress_request, data, options)
+            except BrokenProcessPool:
+                # A worker died (e.g. killed for using too much memory), which breaks the whole pool for good
+                self.metrics.count("pool_restarts")
+                pool.shutdown(wait=False, cancel_futures=True)
+                self._pool = ProcessPoolExecutor(max_workers=self.workers)
+                return self._pool.submit(compress_request, data, options)
+
+    def _release(self, future):
+        self.metrics.leave()
+        self._slots.release()
+
+    def close(self):
+        self._pool.shutdown(cancel_futures=True)
+
+
+class CompressionHandler(BaseHTTPRequestHandler):
+    server_version = "ImageSVD"
+
+    def _send(self, status, body, content_type="application/json", headers=None):
+        if isinstance(body, (dict, list)):
+            body = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, str(value))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _error(self, status, message, headers=None):
+        self._send(status, {"error": message}, headers=headers)
+
+    def do_GET(self):
+        service = self.server.service
+        path = urlparse(self.path).path
+        if path == "/metrics":
+            self._send(200, service.metrics.snapshot(service.workers, service.max_queue))
+        elif path == "/health":
+            self._send(200, {"status": "ok"})
+        else:
+            self._error(404, f"No such endpoint {path}")
+
+    def do_POST(self):
+        arrived = time.perf_counter()
+        service = self.server.service
+        url = urlparse(self.path)
+        if url.path != "/compress":
+            return self._error(404, f"No such endpoint {url.path}")
+        if "Content-Length" not in self.headers:
+            return self._error(411, "Content-Length required")
+        try:
+            length = int(self.headers["Content-Length"])
+        except ValueError:
+            length = -1
+        if length < 0:
+            self.close_connection = True
+            return self._error(400, "Content-Length must be a non-negative integer")
+        if length > service.max_body:
+            self.close_connection = True
+            return self._error(413, f"Images are limited to {service.max_body} bytes")
+        try:
+            options = service.options(url.query)
+        except ValueError as e:
+            service.metrics.count("bad_request")
+            return self._error(400, str(e))
+        data = self.rfile.read(length)
+
+        try:
+            future = service.submit(data, options)
+        except Exception as e:
+            service.metrics.count("failed")
+            return self._error(500, f"Could not queue the request: {e}")
+        if future is None:
+            return self._error(503, "Too many requests in progress, try again later", headers={"Retry-After": 1})
+        try:
+            output, rank, timings = future.result(timeout=max(0.0, service.timeout - (time.perf_counter() - arrived)))
+        except BrokenProcessPool:
+            service.metrics.count("failed")
+            return self._error(503, "The worker handling the request died, try again", headers={"Retry-After": 1})
+        except TimeoutError:
+            future.cancel()
+            service.metrics.count("timed_out")
+            return self._error(504, f"Compression took longer than {service.timeout} s")
+        except Exception as e:
+            service.metrics.count("failed")
+            return self._error(422, f"Could not compress the image: {e}")
+
+        latency = time.perf_counter() - arrived
+        service.metrics.record(latency)
+        fmt = FORMATS[options["format"]]
+        mime = "application/octet-stream" if fmt is None else IMAGE_FORMATS[fmt][1]
+        self._send(200, output, content_type=mime, headers={
+            "X-Rank": rank,
+            "X-Processing-Ms": f"{1000 * latency:.1f}",
+            "X-Stage-Ms": json.dumps({stage: round(1000 * seconds, 1) for stage, seconds in timings.items()}),
+        })
+
+    def log_message(self, format, *args):
+        if not self.server.quiet:
+            super().log_message(format, *args)
+
+
+def serve(service, host="127.0.0.1", port=8000, quiet=False):
+    """
+    A function to run the HTTP server until interrupted.
+
+    Parameters:
+    -----------
+    - service (CompressionService): The pool and queue that handle the requests.
+    - host (str): Interface to listen on, local only by default.
+    - port (int): Port to listen on.
+    - quiet (bool): Do not log every request.
+    """
+    server = ThreadingHTTPServer((host, port), CompressionHandler)
+    server.daemon_threads = True
+    server.service = service
+    server.quiet = quiet
+    print(f"Serving on http://{host}:{server.server_port} with {service.workers} workers, "
+          f"at most {service.max_queue} requests at once")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        service.close()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Serve SVD image compression over HTTP.")
+    parser.add_argument("--host", default="127.0.0.1", help="Interface to listen on.")
+    parser.add_argument("--port", type=int, default=8000, help="Port to listen on.")
+    parser.add_argument("--workers", type=int, default=os.cpu_count(), help="Worker processes.")
+    parser.add_argument("--max-queue", type=int, help="Requests accepted at once before answering 503 (default: 4 per worker).")
+    parser.add_argument("--timeout", type=float, default=30.0, help="Seconds before a request is answered with 504.")
+    parser.add_argument("--max-body", type=int, default=32, help="Largest accepted upload in MB.")
+    parser.add_argument("--rank", type=int, default=50, help="Rank used when a request gives no target.")
+    parser.add_argument("--format", choices=list(FORMATS), default="jpg", help="Default output format.")
+    parser.add_argument("--quality", type=int, default=90, help="Default quality of JPEG and WebP output.")
+    parser.add_argument("--engine", choices=ENGINES, default="exact", help="SVD engine.")
+    parser.add_argument("--max-rank", type=int, help="Factors computed by the randomized engine (default: 200).")
+    parser.add_argument("--tile-size", type=int, default=512, help="Block size of the tiled engine.")
+    parser.add_argument("--tile-budget", choices=TILE_BUDGETS, default="uniform",
+                        help="energy gives busy tiles more of the rank than flat ones, for the same total number of terms.")
+    parser.add_argument("--color-mode", choices=COLOR_MODES, default="rgb", help="Color mode of the decomposition.")
+    parser.add_argument("--single-precision", action="store_true", help="Keep the factors and rebuild in float32, which halves their memory.")
+    parser.add_argument("--memory-limit", type=int, default=1024,
+                        help="Peak MB per request; larger images fall back to a truncated or tiled SVD, or fail with 422.")
+    parser.add_argument("-q", "--quiet", action="store_true", help="Do not log every request.")
+    args = parser.parse_args(argv)
+    if args.engine == "randomized" and args.max_rank is None:
+        args.max_rank = 200
+
+    defaults = {
+        "rank": args.rank, "energy": None, "psnr": None, "format": args.format, "quality": args.quality,
+        "engine": args.engine, "max_rank": args.max_rank, "tile_size": args.tile_size, "color_mode": args.color_mode,
+        "tile_budget": args.tile_budget, "dtype": "float32" if args.single_precision else "float64",
+        "memory_limit": args.memory_limit * 2**20 if args.memory_limit else None,
+    }
+    service = CompressionService(defaults, workers=args.workers, max_queue=args.max_queue, timeout=args.timeout,
+                                 max_body=args.max_body * 2**20)
+    serve(service, host=args.host, port=args.port, quiet=args.quiet)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,331 @@
+"""
+Reading and writing of .svdz files, a container that stores the truncated SVD factors of an image.
+
+Layout (all little-endian):
+
+- header: magic b"SVDZ", version, quantization, codec, channels, height, width, rank
+- bands (version 2): number of rank bands, then the rank at which each band ends
+- section table: (offset, length) of the U, S and Vt sections of every channel, band after band
+- sections: S as float32, U (stored transposed, one row per singular vector) and Vt quantized per vector.
+  int8 sections start with one float32 scale per vector.
+
+Files written with several bands (e.g. ranks 1, 2, 4, ...) store the leading singular vectors of every channel
+first, so a partially received file can already be displayed at a lower rank, see `stream`. Version 1 files
+have a single band and no band table.
+"""
+import mmap
+import struct
+import zlib
+
+import numpy as np
+
+from processor import progressive_ranks
+
+
+MAGIC = b"SVDZ"
+VERSION = 2
+HEADER = struct.Struct("<4sBBBxIIII")
+BAND = struct.Struct("<I")
+SECTION = struct.Struct("<QQ")
+
+QUANTIZATIONS = {"float32": 0, "float16": 1, "int8": 2}
+CODECS = {"none": 0, "zlib": 1}
+
+
+def _quantize(vectors, quantization):
+    vectors = np.ascontiguousarray(vectors, dtype=np.float32)
+    if quantization == "float32":
+        return vectors.tobytes()
+    if quantization == "float16":
+        return vectors.astype(np.float16).tobytes()
+    # Singular vectors are unit length, but their entries vary a lot from one vector to the next,
+    # so each vector gets its own scale
+    scales = np.abs(vectors).max(axis=1) / 127
+    scales[scales == 0] = 1
+    q = np.rint(vectors / scales[:, np.newaxis]).astype(np.int8)
+    return scales.astype(np.float32).tobytes() + q.tobytes()
+
+
+def _dequantize(buffer, quantization, rank, length):
+    if quantization == "float32":
+        return np.frombuffer(buffer, dtype=np.float32, count=rank * length).reshape(rank, length)
+    if quantization == "float16":
+        return np.frombuffer(buffer, dtype=np.float16, count=rank * length).reshape(rank, length)
+    scales = np.frombuffer(buffer, dtype=np.float32, count=rank)
+    q = np.frombuffer(buffer, dtype=np.int8, count=rank * length, offset=4 * rank).reshape(rank, length)
+    return q, scales
+
+
+def _header_size(buffer):
+    # Bytes needed before the sections start, or None while the band count itself has not arrived
+    if len(buffer) < HEADER.size + BAND.size:
+        return None
+    version, channels = buffer[4], HEADER.unpack_from(buffer, 0)[4]
+    if version == 1:
+        return HEADER.size + SECTION.size * 3 * channels
+    bands, = BAND.unpack_from(buffer, HEADER.size)
+    return HEADER.size + BAND.size * (1 + bands) + SECTION.size * 3 * channels * bands
+
+
+def dumps(factors, rank, quantization="int8", codec="zlib", progressive=False):
+    """
+    A function to encode the first `rank` factors of every channel as .svdz bytes.
+
+    Parameters:
+    -----------
+    - factors (Factors): The decomposition of the image.
+    - rank (int): Number of singular values kept per channel.
+    - quantization (str): "float32", "float16" or "int8" (per-vector scales).
+    - codec (str): "zlib" to entropy code every section, or "none" so the file can be memory-mapped as is.
+    - progressive (bool): Store the factors in bands of ranks 1, 2, 4, ..., so a prefix of the file decodes.
+    """
+    if quantization not in QUANTIZATIONS:
+        raise ValueError(f"Unknown quantization {quantization!r}, expected one of {tuple(QUANTIZATIONS)}")
+    if codec not in CODECS:
+        raise ValueError(f"Unknown codec {codec!r}, expected one of {tuple(CODECS)}")
+    rank = min(rank, factors.max_rank)
+    height, width = factors.shape
+    bands = progressive_ranks(rank) if progressive else [rank]
+
+    sections = []
+    start = 0
+    for stop in bands:
+        for U, S, Vt in (factors[c] for c in range(factors.channels)):
+            sections.append(_quantize(U[:, start:stop].T, quantization))
+            sections.append(np.ascontiguousarray(S[start:stop], dtype=np.float32).tobytes())
+            sections.append(_quantize(Vt[start:stop], quantization))
+        start = stop
+    if codec == "zlib":
+        sections = [zlib.compress(section, 9) for section in sections]
+
+    header = HEADER.pack(MAGIC, VERSION, QUANTIZATIONS[quantization], CODECS[codec],
+                         factors.channels, height, width, rank)
+    band_table = [BAND.pack(len(bands)), *(BAND.pack(stop) for stop in bands)]
+    offset = HEADER.size + BAND.size * len(band_table) + SECTION.size * len(sections)
+    table = []
+    for section in sections:
+        table.append(SECTION.pack(offset, len(section)))
+        offset += len(section)
+    return b"".join([header, *band_table, *table, *sections])
+
+
+def save(file, factors, rank, quantization="int8", codec="zlib", progressive=False):
+    """
+    A function to write an .svdz file and return the number of bytes stored.
+
+    Parameters:
+    -----------
+    - file (str or file object): Destination path or binary file object.
+    - factors, rank, quantization, codec, progressive: See `dumps`.
+    """
+    data = dumps(factors, rank, quantization=quantization, codec=codec, progressive=progressive)
+    if isinstance(file, (str, bytes)) or hasattr(file, "__fspath__"):
+        with open(file, "wb") as f:
+            f.write(data)
+    else:
+        file.write(data)
+    return len(data)
+
+
+class SvdzReader:
+    def __init__(self, source) -> None:
+        """
+        Decoder for .svdz files. Paths are memory-mapped, so sections are only paged in when a channel is decoded.
+
+        Bytes may be a truncated file, in which case only the bands that arrived completely are decoded.
+
+        Parameters:
+        -----------
+        - source (str, bytes or file object): The .svdz data.
+        """
+        self._file = None
+        if isinstance(source, (bytes, bytearray, memoryview)):
+            self._buffer = memoryview(source)
+        elif hasattr(source, "read"):
+            self._buffer = memoryview(source.read())
+        else:
+            self._file = open(source, "rb")
+            self._buffer = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        if len(self._buffer) < HEADER.size:
+            raise ValueError("Truncated .svdz header")
+        magic, version, quantization, codec, channels, height, width, rank = HEADER.unpack_from(self._buffer, 0)
+        if magic != MAGIC:
+            raise ValueError("Not an .svdz file")
+        if version not in (1, VERSION):
+            raise ValueError(f"Unsupported .svdz version {version}")
+        size = _header_size(self._buffer)
+        if size is None or len(self._buffer) < size:
+            raise ValueError("Truncated .svdz header")
+        self.quantization = {v: k for k, v in QUANTIZATIONS.items()}[quantization]
+        self.codec = {v: k for k, v in CODECS.items()}[codec]
+        self.channels, self.height, self.width, self.rank = channels, height, width, rank
+        if version == 1:
+            self.bands = [rank]
+            table = HEADER.size
+        else:
+            count, = BAND.unpack_from(self._buffer, HEADER.size)
+            self.bands = [BAND.unpack_from(self._buffer, HEADER.size + BAND.size * (1 + i))[0] for i in range(count)]
+            table = HEADER.size + BAND.size * (1 + count)
+        self._sections = [
+            [SECTION.unpack_from(self._buffer, table + SECTION.size * (3 * channels * b + i)) for i in range(3 * channels)]
+            for b in range(len(self.bands))
+        ]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        if self._file is not None:
+            self._buffer.close()
+            self._file.close()
+            self._file = None
+
+    @property
+    def nbytes(self):
+        return len(self._buffer)
+
+    @property
+    def available_rank(self):
+        """
+        Rank that can be decoded from the bytes at hand, the full rank unless the file is truncated.
+        """
+        rank = 0
+        for stop, sections in zip(self.bands, self._sections):
+            if max(offset + length for offset, length in sections) > len(self._buffer):
+                break
+            rank = stop
+        return rank
+
+    def _section(self, band, channel, part):
+        offset, length = self._sections[band][3 * channel + part]
+        data = self._buffer[offset:offset + length]
+        if self.codec == "zlib":
+            return zlib.decompress(data)
+        return data
+
+    def _bands(self, rank):
+        # (band, start, stop) of the bands holding the first `rank` factors
+        start = 0
+        for band, stop in enumerate(self.bands):
+            if start >= rank:
+                break
+            yield band, start, stop
+            start = stop
+
+    def _vectors(self, channel, part, length, rank):
+        vectors, scales = [], []
+        for band, start, stop in self._bands(rank):
+            decoded = _dequantize(self._section(band, channel, part), self.quantization, stop - start, length)
+            if self.quantization == "int8":
+                q, s = decoded
+                vectors.append(q[:rank - start])
+                scales.append(s[:rank - start])
+            else:
+                vectors.append(decoded[:rank - start])
+        if not vectors:
+            return np.empty((0, length), dtype=np.float32), None
+        return np.concatenate(vectors), np.concatenate(scales) if scales else None
+
+    def _singular_values(self, channel, rank):
+        return np.concatenate([
+            np.frombuffer(self._section(band, channel, 1), dtype=np.float32, count=stop - start)[:rank - start]
+            for band, start, stop in self._bands(rank)
+        ] or [np.empty(0, dtype=np.float32)])
+
+    def channel(self, channel, rank=None):
+        """
+        A function to decode the factors of one channel as float32 (U, S, Vt).
+
+        Parameters:
+        -----------
+        - channel (int): Index of the channel.
+        - rank (int): Number of factors to decode, all available factors by default.
+        """
+        rank = self.available_rank if rank is None else min(rank, self.available_rank)
+        Ut, u_scales = self._vectors(channel, 0, self.height, rank)
+        Vt, v_scales = self._vectors(channel, 2, self.width, rank)
+        S = self._singular_values(channel, rank)
+        Ut = Ut.astype(np.float32)
+        Vt = Vt.astype(np.float32)
+        if u_scales is not None:
+            Ut *= u_scales[:, np.newaxis]
+            Vt *= v_scales[:, np.newaxis]
+        return Ut.T, S.copy(), Vt
+
+    def reconstruct(self, rank=None, out=None, rows=256):
+        """
+        A function to rebuild the image one channel and one block of rows at a time.
+
+        Parameters:
+        -----------
+        - rank (int): Number of factors used, all available factors by default.
+        - out (uint8 array): Optional destination of shape (H, W) or (H, W, C).
+        - rows (int): Height of the row blocks, which bounds the float working memory.
+        """
+        rank = self.available_rank if rank is None else min(rank, self.available_rank)
+        shape = (self.height, self.width) if self.channels == 1 else (self.height, self.width, self.channels)
+        out = np.empty(shape, dtype=np.uint8) if out is None else out
+        channels = out.reshape(self.height, self.width, self.channels)
+        work = np.empty((min(rows, self.height), self.width), dtype=np.float32)
+        for c in range(self.channels):
+            Ut, u_scales = self._vectors(c, 0, self.height, rank)
+            Vt, v_scales = self._vectors(c, 2, self.width, rank)
+            S = self._singular_values(c, rank)
+            # Fold S and the quantization scales into Vt once, so each row block is a single matmul
+            weights = S if u_scales is None else S * u_scales * v_scales
+            SVt = Vt.astype(np.float32) * weights[:, np.newaxis]
+            for start in range(0, self.height, rows):
+                stop = min(start + rows, self.height)
+                block = work[:stop - start]
+                np.matmul(Ut[:, start:stop].T.astype(np.float32), SVt, out=block)
+                np.clip(block, 0, 255, out=block)
+                np.rint(block, out=block)
+                np.copyto(channels[start:stop, :, c], block, casting="unsafe")
+        return out
+
+
+def stream(chunks, rows=256):
+    """
+    A generator of (rank, image) previews of an .svdz file that is still arriving, one per completed band.
+
+    Every preview is decoded from scratch, which for bands doubling in rank costs about twice a single decode.
+
+    Parameters:
+    -----------
+    - chunks (iterable of bytes): The file in pieces, e.g. from a socket or an HTTP response.
+    - rows (int): Row block height used by SvdzReader.reconstruct.
+    """
+    buffer = bytearray()
+    shown = 0
+    for chunk in chunks:
+        buffer += chunk
+        size = _header_size(buffer)
+        if size is None or len(buffer) < size:
+            continue
+        # A copy, so the reader never holds a view on the bytearray that is still growing
+        reader = SvdzReader(bytes(buffer))
+        if reader.available_rank > shown:
+            shown = reader.available_rank
+            yield shown, reader.reconstruct(shown, rows=rows)
+
+
+def compression_report(stored_bytes, shape):
+    """
+    A function to compare the size of an .svdz file with the raw pixels it encodes.
+
+    Parameters:
+    -----------
+    - stored_bytes (int): Size of the .svdz data.
+    - shape (tuple): Shape of the original uint8 image.
+    """
+    original_bytes = int(np.prod(shape))
+    return {
+        "stored_bytes": stored_bytes,
+        "original_bytes": original_bytes,
+        "ratio": original_bytes / stored_bytes if stored_bytes else float("inf"),
+        "bits_per_pixel": 8 * stored_bytes / (shape[0] * shape[1]),
+    }
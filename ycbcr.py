@@ -0,0 +1,145 @@
+import math
+
+import numpy as np
+
+
+# Full-range BT.601 as used by JPEG/JFIF
+RGB_TO_YCBCR = np.array([
+    [0.299, 0.587, 0.114],
+    [-0.168736, -0.331264, 0.5],
+    [0.5, -0.418688, -0.081312],
+])
+YCBCR_TO_RGB = np.array([
+    [1.0, 0.0, 1.402],
+    [1.0, -0.344136, -0.714136],
+    [1.0, 1.772, 0.0],
+])
+CHROMA_OFFSET = np.array([0.0, 128.0, 128.0])
+
+
+def rgb_to_ycbcr(img, dtype=np.float64):
+    """
+    A function to convert an (H, W, 3) RGB image to floating point YCbCr.
+
+    Parameters:
+    -----------
+    - img (array): The RGB image.
+    - dtype (type): Precision of the result.
+    """
+    return img[:, :, :3] @ RGB_TO_YCBCR.T.astype(dtype) + CHROMA_OFFSET.astype(dtype)
+
+
+def ycbcr_to_rgb(ycc, out=None):
+    """
+    A function to convert an (H, W, 3) YCbCr image back to clipped and rounded uint8 RGB.
+
+    Parameters:
+    -----------
+    - ycc (array): The YCbCr image.
+    - out (uint8 array): Optional destination.
+    """
+    rgb = (ycc - CHROMA_OFFSET.astype(ycc.dtype)) @ YCBCR_TO_RGB.T.astype(ycc.dtype)
+    np.clip(rgb, 0, 255, out=rgb)
+    np.rint(rgb, out=rgb)
+    if out is None:
+        return rgb.astype(np.uint8)
+    np.copyto(out, rgb, casting="unsafe")
+    return out
+
+
+def subsample(img, factor):
+    """
+    A function to shrink an (H, W, C) image by averaging factor x factor blocks, padding the edges if needed.
+
+    Parameters:
+    -----------
+    - img (array): The image.
+    - factor (int): Subsampling factor along both axes, 1 leaves the image unchanged.
+    """
+    if factor == 1:
+        return img
+    height, width = img.shape[:2]
+    padded = np.pad(img, ((0, -height % factor), (0, -width % factor), (0, 0)), mode="edge")
+    h, w = padded.shape[0] // factor, padded.shape[1] // factor
+    return padded.reshape(h, factor, w, factor, -1).mean(axis=(1, 3))
+
+
+class YCbCrFactors:
+    def __init__(self, luma, chroma, subsampling, shape) -> None:
+        """
+        Decompositions of the luma channel at full resolution and of both chroma channels at reduced resolution.
+
+        Parameters:
+        -----------
+        - luma (Factors): Decomposition of Y.
+        - chroma (Factors): Decomposition of Cb and Cr minus their neutral value 128, subsampled by `subsampling`.
+        - subsampling (int): Chroma subsampling factor along both axes.
+        - shape (tuple): Height and width of the image.
+        """
+        self.luma = luma
+        self.chroma = chroma
+        self.subsampling = subsampling
+        self._shape = shape
+        # Nearest-neighbour upsampling by f multiplies the chroma singular values by f, so after scaling the
+        # three spectra share one scale. Chroma has fewer singular values and is padded with zeros.
+        S = np.zeros((3, luma.max_rank), dtype=luma.S.dtype)
+        S[0] = luma.S[0]
+        S[1:, :chroma.max_rank] = subsampling * chroma.S[:, :luma.max_rank]
+        self.S = S
+        self.total_energy = np.concatenate([luma.total_energy, subsampling**2 * chroma.total_energy])
+
+    @property
+    def channels(self):
+        return 3
+
+    @property
+    def shape(self):
+        return self._shape
+
+    @property
+    def max_rank(self):
+        return self.luma.max_rank
+
+    @property
+    def nbytes(self):
+        return self.luma.nbytes + self.chroma.nbytes
+
+    def reconstructor(self, dtype=np.float64, chroma_ratio=0.5):
+        return YCbCrReconstructor(self, dtype=dtype, chroma_ratio=chroma_ratio)
+
+
+class YCbCrReconstructor:
+    def __init__(self, factors, dtype=np.float64, chroma_ratio=0.5) -> None:
+        """
+        Rebuilds an RGB image from YCbCr factors, with its own (smaller) rank for the chroma channels.
+
+        Parameters:
+        -----------
+        - factors (YCbCrFactors): The decomposition to reconstruct from.
+        - dtype (type): Working precision.
+        - chroma_ratio (float): Chroma rank as a fraction of the luma rank. Can be changed between calls.
+        """
+        self.factors = factors
+        self.dtype = np.dtype(dtype)
+        self.chroma_ratio = chroma_ratio
+        self.luma = factors.luma.reconstructor(dtype=dtype)
+        self.chroma = factors.chroma.reconstructor(dtype=dtype)
+        height, width = factors.shape
+        self._ycc = np.empty((height, width, 3), dtype=self.dtype)
+        self.out = np.empty((height, width, 3), dtype=np.uint8)
+
+    def chroma_rank(self, rank):
+        return min(math.ceil(rank * self.chroma_ratio), self.factors.chroma.max_rank)
+
+    def reconstruct(self, rank, out=None):
+        out = self.out if out is None else out
+        f = self.factors.subsampling
+        # The unclipped float planes, so the pixels are only clipped and rounded once, after the conversion
+        self._ycc[:, :, 0] = self.luma.approximate(rank)[0]
+        chroma = np.moveaxis(self.chroma.approximate(self.chroma_rank(rank)), 0, -1)
+        # Nearest-neighbour upsampling straight into the YCbCr buffer, one phase of the f x f block at a time
+        for dy in range(f):
+            for dx in range(f):
+                target = self._ycc[dy::f, dx::f, 1:]
+                np.add(chroma[:target.shape[0], :target.shape[1]], CHROMA_OFFSET[1:].astype(self.dtype), out=target)
+        return ycbcr_to_rgb(self._ycc, out=out)